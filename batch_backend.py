@@ -0,0 +1,197 @@
+"""
+Two-phase batch backend for ChessLLM, for sending the prompts of a large sweep through a bulk batch endpoint
+instead of one synchronous completion call per ply.
+
+Puzzles are advanced in waves. In every wave, each unfinished puzzle is replayed from the start with
+a ChessLLM(backend="batch"): plies whose responses are already cached are played instantly, and the
+first cache miss stops the puzzle and is collected as a pending request. All pending requests of the
+wave are written to a JSONL request file (one line per request, in the OpenAI batch format), the
+responses are read back from a JSONL response file into the response cache, and the next wave
+advances every puzzle by (at least) one more ply.
+
+The responses can come from a real batch job (FileResponder waits for the response file to appear),
+or from LocalResponder, a stand-in that answers each prompt locally so the whole flow can be run offline.
+"""
+
+import io
+import json
+import time
+import argparse
+import itertools
+from pathlib import Path
+from collections import Counter
+
+import chess
+import chess.pgn
+import pandas as pd
+
+import chessllm
+from chessllm import PendingRequest
+from puzzle_solver import solve_puzzle, board_from_pgn
+
+CHAT_URL = "/v1/chat/completions"
+COMPLETIONS_URL = "/v1/completions"
+COMPLETION_MODELS = ("davinci-002", "babbage-002")  # besides the *-instruct models
+
+
+def is_completion_model(model):
+    """Whether a model is only served by the (legacy) completions endpoint, like gpt-3.5-turbo-instruct."""
+    name = model.split("/")[-1]
+    return "instruct" in name or name in COMPLETION_MODELS
+
+
+def write_requests(pending, path):
+    """
+    Write the pending requests of a ChessLLM to a JSONL file, one batch request per line: completion
+    models get a prompt on /v1/completions, chat models a user message on /v1/chat/completions.
+    """
+    with open(path, "w") as f:
+        for key, request in pending.items():
+            body = {"model": request["model"],
+                    "max_tokens": request["num_tokens"],
+                    "temperature": request["temperature"]}
+            if is_completion_model(request["model"]):
+                url, body["prompt"] = COMPLETIONS_URL, request["content"]
+            else:
+                url, body["messages"] = CHAT_URL, [{"role": "user", "content": request["content"]}]
+            if request["options"].get("stop"):
+                body["stop"] = request["options"]["stop"]
+            f.write(json.dumps({"custom_id": key, "method": "POST", "url": url, "body": body}) + "\n")
+
+
+def response_text(body):
+    """The reply in the body of a completions or chat completions response."""
+    choice = body["choices"][0]
+    return choice["text"] if "text" in choice else choice["message"]["content"]
+
+
+def ingest_responses(engine, pending, path):
+    """Read a JSONL response file into the engine's response cache. Returns the custom_ids of the responses stored."""
+    stored = set()
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            request = pending.get(result["custom_id"])
+            response = result.get("response") or {}
+            if request is None or result.get("error") or response.get("status_code", 200) != 200:
+                print("Skipping response", result["custom_id"], result.get("error"))
+                continue
+            text = response_text(response["body"])
+            engine.cache.put(request["model"], request["content"], request["num_tokens"], request["temperature"],
+                             text, **request["options"])
+            stored.add(result["custom_id"])
+    return stored
+
+
+def first_legal_move_reply(prompt, max_tokens=None, temperature=None):
+    """
+    Offline stand-in for a model: replies with the first legal move (in SAN order) of the prompt's position.
+    """
+    movetext = prompt.rsplit("]\n\n", 1)[-1]
+    board = chess.Board()
+    for move in chess.pgn.read_game(io.StringIO(movetext)).mainline_moves():
+        board.push(move)
+    moves = sorted(board.san(move) for move in board.legal_moves)
+    return " " + moves[0] if moves else ""
+
+
+class LocalResponder:
+    """Answers a request file locally with answer(prompt, max_tokens, temperature) and writes the response file."""
+
+    def __init__(self, answer=first_legal_move_reply):
+        self.answer = answer
+
+    def __call__(self, request_path):
+        response_path = Path(str(request_path).replace(".requests.jsonl", ".responses.jsonl"))
+        with open(request_path) as f_in, open(response_path, "w") as f_out:
+            for line in f_in:
+                request = json.loads(line)
+                body = request["body"]
+                prompt = body["prompt"] if "prompt" in body else body["messages"][0]["content"]
+                text = self.answer(prompt, body["max_tokens"], body["temperature"])
+                choice = {"text": text} if "prompt" in body else {"message": {"content": text}}
+                f_out.write(json.dumps({"custom_id": request["custom_id"], "error": None,
+                                        "response": {"status_code": 200, "body": {"choices": [choice]}}}) + "\n")
+        return response_path
+
+
+class FileResponder:
+    """Waits until the response file of a request file has been put next to it (e.g. downloaded from a batch job)."""
+
+    def __init__(self, poll_interval=60):
+        self.poll_interval = poll_interval
+
+    def __call__(self, request_path):
+        response_path = Path(str(request_path).replace(".requests.jsonl", ".responses.jsonl"))
+        print(f"Submit {request_path} as a batch job and save its output as {response_path}")
+        while not response_path.exists():
+            time.sleep(self.poll_interval)
+        return response_path
+
+
+def run_waves(engine, puzzles, workdir, submit, speculative=False, max_waves=100, max_retries=1):
+    """
+    Solve (board, solution) puzzles with a batch-backend engine, one wave of requests at a time.
+    submit(request_path) must return the path of the matching response file.
+    A request that gets no usable response is sent again in up to max_retries later waves; after that,
+    the puzzles waiting for it are given up on.
+    Returns the results in input order (None for puzzles given up on or still unfinished after max_waves).
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    results = [None] * len(puzzles)
+    unfinished = set(range(len(puzzles)))
+    failures = Counter()  # custom_id -> waves in which the request got no usable response
+    given_up = set()
+
+    for wave in itertools.count():
+        engine.pending.clear()
+        for i in sorted(unfinished):
+            board, solution = puzzles[i]
+            try:
+                results[i] = solve_puzzle(board.copy(), solution, engine, speculative)
+                unfinished.discard(i)
+            except PendingRequest as e:
+                key = e.args[0]
+                if failures[key] > max_retries:
+                    print(f"Giving up on puzzle {i}: request {key} failed {failures[key]} times")
+                    engine.pending.pop(key, None)
+                    unfinished.discard(i)
+                    given_up.add(i)
+
+        print(f"Wave {wave}: {len(puzzles) - len(unfinished) - len(given_up)}/{len(puzzles)} puzzles done, "
+              f"{len(given_up)} given up, {len(engine.pending)} requests pending")
+        if not unfinished or wave >= max_waves:
+            break
+
+        pending = dict(engine.pending)
+        request_path = workdir / f"wave_{wave:03d}.requests.jsonl"
+        write_requests(pending, request_path)
+        stored = ingest_responses(engine, pending, submit(request_path))
+        failures.update(key for key in pending if key not in stored)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file_name", "-f", default="/data/chess-data/lichess_puzzles/pgn_puzzles.csv", help="Puzzle file (uid, rating, pgn, solution)")
+    parser.add_argument("--num_puzzles", "-n", type=int, default=100, help="Number of puzzles to solve")
+    parser.add_argument("--workdir", default="/data/chess-data/lichess_puzzles/batches", help="Where request and response files are written")
+    parser.add_argument("--cache_path", default=chessllm.DEFAULT_CACHE_PATH, help="Response cache to fill")
+    parser.add_argument("--model", default="gpt-3.5-turbo-instruct", help="Model name")
+    parser.add_argument("--local", action="store_true", help="Answer the request files with the offline stand-in instead of waiting for batch results")
+    parser.add_argument("--speculative", action="store_true", help="Play the moves of the model's continuation that match the solution without new requests")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.file_name, header=None, names=['uid', 'rating', 'pgn', 'solution'], nrows=args.num_puzzles)
+    puzzles = [(board_from_pgn(row['pgn']), row['solution']) for _, row in df.iterrows()]
+
+    engine = chessllm.ChessLLM(None, config={"temperature": 0, "num_lookahead_tokens": 30}, model=args.model,
+                               cache_path=args.cache_path, backend="batch")
+    submit = LocalResponder() if args.local else FileResponder()
+    results = run_waves(engine, puzzles, args.workdir, submit, speculative=args.speculative)
+    solved = [r for r in results if r is not None]
+    print(f"Finished {len(solved)}/{len(results)} puzzles, accuracy {sum(solved) / max(len(solved), 1):.3f}")
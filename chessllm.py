@@ -16,83 +16,362 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
+import json
+import math
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 import chess
 import chess.engine
 import chess.pgn
 from litellm import completion
 
-from cachier import cachier
-from cachier import set_default_params as cachier_set
-import datetime
-cachier_set(stale_after=datetime.timedelta(days=30), pickle_reload=False, cache_dir="/data/chess/cache")
+from response_cache import ResponseCache, DEFAULT_CACHE_PATH, cache_key
+from local_backend import LocalModelClient, DEFAULT_URL as DEFAULT_LOCAL_URL
+
+# A reply contains a complete first move once the move (optionally after a move number) is followed by whitespace
+FIRST_MOVE_COMPLETE = re.compile(r"^\s*(?:\d+\.+\s*)?[^\s.]+\s")
+MOVE_TOKENS = 9  # A single move might take as many as 9 tokens (3 for the number + 6 for, e.g., 'N3xg5+)
+
+# Probability mass of a move distribution that does not land on a single legal move
+OTHER_MOVE = "*"
+DEFAULT_TOP_K = 5  # the completions API returns at most 5 alternatives per token
+MOVE_NUMBER = re.compile(r"\d+\.+\s*")
+
+# The tokens of a reply: comments, move numbers (also glued to the move, as in "12.Nf3"), NAGs, and moves
+# (or results) with their trailing annotations
+CONTINUATION_TOKEN = re.compile(r"(?P<comment>\{[^}]*\}?)|(?P<number>\d*\.+)|(?P<nag>\$\d+)|(?P<move>[^\s{}$]+?)[!?]*(?=[\s{$]|$)")
+RESULTS = {"1-0", "0-1", "1/2-1/2", "*"}
+# Why parse_continuation stopped
+STOP_END = "end"  # the reply ran out
+STOP_ILLEGAL = "illegal"  # a token that isn't a legal move
+STOP_RESULT = "result"  # a game result
+STOP_GAME_OVER = "game_over"  # a move after the end of the game
+SAN_TABLE_POSITIONS = 100000  # positions kept by SanTables
+
+DEFAULT_HEADER = """[White "Magnus Carlsen"]\n[Black "Garry Kasparov"]\n[WhiteElo "2900"]\n[BlackElo "2800"]\n\n"""
+
+class PgnPrompt:
+    """
+    The PGN movetext of a board's game, kept up to date incrementally: only the moves pushed to the
+    board since the last call are converted to SAN. The text is the same as the movetext of
+    str(chess.pgn.Game().from_board(board)), so prompts (and cache keys) don't change.
+    """
+
+    def __init__(self, board):
+        self.board = board.root()
+        self.tokens = []
+        self.num_moves = 0
+        self.last_move = None
+        self._text = ""
+
+    @classmethod
+    def of(cls, board):
+        """The prompt state attached to a board, created (or rebuilt, if the board was rewound) as needed."""
+        prompt = getattr(board, "_chessllm_prompt", None)
+        if prompt is None or not prompt.follows(board):
+            prompt = cls(board)
+            board._chessllm_prompt = prompt
+        prompt.sync(board)
+        return prompt
+
+    def follows(self, board):
+        """Whether the board's move stack still starts with the moves this prompt has seen."""
+        stack = board.move_stack
+        return len(stack) >= self.num_moves and (self.num_moves == 0 or stack[self.num_moves - 1] is self.last_move)
+
+    def sync(self, board):
+        for move in board.move_stack[self.num_moves:]:
+            san = self.board.san(move)
+            if self.board.turn == chess.WHITE:
+                self.tokens.append(f"{self.board.fullmove_number}. {san}")
+            elif not self.tokens:
+                self.tokens.append(f"{self.board.fullmove_number}... {san}")
+            else:
+                self.tokens.append(san)
+            self.board.push(move)
+            self._text = None
+        self.num_moves = len(board.move_stack)
+        if self.num_moves:
+            self.last_move = board.move_stack[-1]
+
+    def movetext(self):
+        if self._text is None:
+            self._text = " ".join(self.tokens)
+        return self._text
+
+    def prompt(self, header):
+        """The header, the moves so far, and the number of the next move if White is to play."""
+        text = self.movetext()
+        if self.board.turn == chess.WHITE:
+            number = f"{self.board.fullmove_number}."
+            text = f"{text} {number}" if text else number
+        return header + text
+
+class PendingRequest(Exception):
+    """Raised by make_request with the batch backend when the response is not in the cache yet."""
+
+class SingleFlight:
+    """
+    Merges concurrent calls with the same key: the first caller runs the function,
+    and callers arriving while it is in flight wait for its result instead of calling again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.calls = 0
+        self.saved = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.calls += 1
+            else:
+                self.saved += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+def _field(obj, name):
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def parse_top_logprobs(logprobs):
+    """
+    Per generated token, [token, {alternative: logprob}] (the token itself included), from either the chat
+    format ({"content": [{"token", "logprob", "top_logprobs": [{"token", "logprob"}]}]}) or the completions
+    and local_backend format ({"tokens", "token_logprobs", "top_logprobs": [{token: logprob}]}).
+    """
+    steps = []
+    content = _field(logprobs, "content")
+    if content is not None:
+        for entry in content:
+            top = {_field(alt, "token"): _field(alt, "logprob") for alt in _field(entry, "top_logprobs") or []}
+            top.setdefault(_field(entry, "token"), _field(entry, "logprob"))
+            steps.append([_field(entry, "token"), top])
+        return steps
+    tokens = _field(logprobs, "tokens") or []
+    token_logprobs = _field(logprobs, "token_logprobs") or [0.0] * len(tokens)
+    for token, logprob, top in zip(tokens, token_logprobs, _field(logprobs, "top_logprobs") or []):
+        top = dict(top or {})
+        top.setdefault(token, logprob)
+        steps.append([token, top])
+    return steps
+
+
+def resolve_move(board, legal, text, final=False):
+    """
+    The legal move (in SAN) that a reply starting with text stands for, OTHER_MOVE if it can't be a legal move,
+    or None if it is still ambiguous (e.g. " N" when several knight moves are legal).
+    Moves are validated like in try_moves: a move number is skipped, and a complete move must parse as SAN.
+    """
+    body = text.lstrip()
+    number = MOVE_NUMBER.match(body)
+    if number:
+        body = body[number.end():]
+    if not body:
+        return OTHER_MOVE if final else None
+    word = body.split()[0]
+    if word.isdigit() and len(body) == len(word) and not final:
+        return None  # the start of a move number
+    if final or len(body) > len(word):
+        try:
+            return board.san(board.parse_san(word))
+        except ValueError:
+            return OTHER_MOVE
+    candidates = [san for san in legal if san.startswith(word)]
+    if not candidates:
+        return OTHER_MOVE
+    return candidates[0] if len(candidates) == 1 else None
+
+
+class SanTables:
+    """
+    LRU cache of per-position tables from move text, as written in replies, to the legal move it stands for
+    (None if it isn't one). A position that comes up again (the same puzzle under another header, the next
+    ply of a continuation that was already read, ...) is then parsed with dictionary lookups. Tables are
+    filled as tokens are looked up: parsing one token is much cheaper than writing out every legal move.
+    """
+
+    def __init__(self, max_positions=SAN_TABLE_POSITIONS):
+        self.max_positions = max_positions
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+
+    def table(self, board):
+        # python-chess's exact position key (pieces, turn, castling rights, legal en passant square):
+        # much cheaper than a Zobrist hash, and without collisions
+        key = board._transposition_key()
+        with self.lock:
+            table = self.tables.get(key)
+            if table is None:
+                table = self.tables[key] = {}
+                if len(self.tables) > self.max_positions:
+                    self.tables.popitem(last=False)
+            else:
+                self.tables.move_to_end(key)
+        return table
+
+    def lookup(self, board, word):
+        table = self.table(board)
+        if word not in table:
+            try:
+                table[word] = board.parse_san(word)
+            except ValueError:
+                table[word] = None
+        return table[word]
+
+
+def parse_continuation(board, text, tables=None):
+    """
+    Read a reply as a continuation of the game at board, tokenizing it once. Move numbers (also when glued
+    to the move, as in "12.Nf3"), comments, NAGs and annotations ("Nf3!?") are skipped, and a reply starting
+    with "-O" (the rest of a castling move whose "O" the model took as given) is read as castling.
+    Returns (moves, stop, token): the legal moves as written (without annotations), why parsing stopped
+    (STOP_END, STOP_ILLEGAL, STOP_RESULT or STOP_GAME_OVER), and the token it stopped at (None at the end).
+    """
+    tables = tables or SanTables()
+    board = board.copy(stack=False)
+    moves = []
+    for match in CONTINUATION_TOKEN.finditer(text):
+        word = match.group("move")
+        if word is None:
+            continue
+        if word in RESULTS:
+            return moves, STOP_RESULT, word
+        if match.start() == 0 and word.startswith("-O"):
+            word = "O" + word
+        move = tables.lookup(board, word)
+        if move is None:
+            return moves, STOP_GAME_OVER if board.outcome() is not None else STOP_ILLEGAL, word
+        board.push(move)
+        moves.append(word)
+    return moves, STOP_END, None
+
+
+def fold_move_distribution(board, steps):
+    """
+    Fold the per-token top logprobs of a reply onto the legal moves of board. Every alternative token along
+    the greedy path is resolved with resolve_move; alternatives that are still ambiguous, and the mass outside
+    the top k, go to OTHER_MOVE. Returns {san: probability}, summing to 1.
+    """
+    legal = {board.san(move) for move in board.legal_moves}
+    distribution = {}
+
+    def add(move, p):
+        if p > 0:
+            distribution[move] = distribution.get(move, 0.0) + p
+
+    prefix, mass = "", 1.0
+    for token, top in steps:
+        for alternative, logprob in top.items():
+            if alternative != token:
+                add(resolve_move(board, legal, prefix + alternative) or OTHER_MOVE, mass * math.exp(logprob))
+        add(OTHER_MOVE, mass * (1 - sum(math.exp(logprob) for logprob in top.values())))
+        mass *= math.exp(top[token])
+        prefix += token
+        move = resolve_move(board, legal, prefix)
+        if move is not None:
+            add(move, mass)
+            return distribution
+    add(resolve_move(board, legal, prefix, final=True), mass)
+    return distribution
+
 
 class ChessLLM:
-    def __init__(self, api_key, config, model : str = "gpt-3.5-turbo-instruct", use_cache : bool = True, **override):
+    def __init__(self, api_key, config, model : str = "gpt-3.5-turbo-instruct", use_cache : bool = True,
+                 cache_path=DEFAULT_CACHE_PATH, header=DEFAULT_HEADER, backend="online", **override):
         self.config = config
         self.model = model
         for k,v in override.items():
             config[k] = v
         self.use_cache = use_cache
+        self.cache = ResponseCache(cache_path) if use_cache else None
         self.api_key = api_key
+        self.header = header
+        self.flights = SingleFlight()
+        # With backend="batch", cache misses are collected in self.pending instead of being sent (see batch_backend.py)
+        assert backend in ("online", "batch"), backend
+        assert backend == "online" or use_cache, "The batch backend delivers responses through the cache"
+        self.backend = backend
+        self.pending = {}
+        self._local_client = None
+        self._local_client_lock = threading.Lock()
+        self.san_tables = SanTables()
 
 
-    def get_query_pgn(self, board, with_header = f"""[White "Magnus Carlsen"]\n[Black "Garry Kasparov"]\n[WhiteElo "2900"]\n[BlackElo "2800"]\n\n"""):
-        pgn = str(chess.pgn.Game().from_board(board))
+    def get_query_pgn(self, board, with_header=None):
+        if with_header is None:
+            with_header = self.header
 
-        if board.outcome() is None:
-            pgn = pgn[:-1].strip()
-        else:
+        if board.outcome() is not None:
             print("Game is over; no moves valid")
             return None
 
-        if board.turn == chess.WHITE:
-            if board.fullmove_number == 1:
-                pgn = pgn + "\n\n1."
-            else:
-                pgn += ' '+str(board.fullmove_number)+"."
-
-        with_header += pgn.split("\n\n")[1]
-
-        return with_header
+        return PgnPrompt.of(board).prompt(with_header)
 
     def try_moves(self, board, next_text):
-        board = board.copy()
-        moves = next_text.split()
-        ok_moves = []
-        for move in moves:
-            if '.' in move:
-                continue
-            try:
-                board.push_san(move)
-                ok_moves.append(move)
-            except:
-                break
-
-        return ok_moves
+        """The legal prefix of a reply, as a list of SAN moves (see parse_continuation)."""
+        return parse_continuation(board, next_text, self.san_tables)[0]
     
-    def get_best_move(self, board, num_tokens=None, conversation=None):
+    def get_continuation(self, board, num_tokens=None, conversation=None, lookahead=True, header=None):
+        """
+        The legal prefix of the model's reply, as a list of SAN moves starting with the move to play now.
+        If config["early_stop"] is set and no lookahead is needed, only enough tokens for one move are
+        requested, and generation stops as soon as one complete move has arrived.
+        header replaces the engine's PGN header for this query (e.g. for header_sweep.py).
+        """
+        early_stop = self.config.get('early_stop', False) and not lookahead
         if num_tokens is None:
-            num_tokens = self.config['num_lookahead_tokens']
+            num_tokens = self.config.get('num_move_tokens', MOVE_TOKENS) if early_stop else self.config['num_lookahead_tokens']
         assert num_tokens >= 9, "A single move might take as many as 9 tokens (3 for the number + 6 for, e.g., 'N3xg5+)."
 
-        pgn_to_query = self.get_query_pgn(board)
+        pgn_to_query = self.get_query_pgn(board, header)
 
         if conversation:
             conversation.send_message("player", f"Querying {self.config['model']} with ... {pgn_to_query.split(']')[-1][-90:]}")
             conversation.send_message("spectator", f"Querying {self.config['model']} with ... {pgn_to_query.split(']')[-1][-90:]}")
-        
-        next_text = self.make_request(pgn_to_query, num_tokens, temperature=self.config['temperature'], model=self.model, ignore_cache = not self.use_cache)
-        if next_text[:2] == "-O":
-            next_text = self.make_request(pgn_to_query+" ", num_tokens, temperature=self.config['temperature'], model=self.model, ignore_cache = not self.use_cache)
+
+        if early_stop:
+            # Whoever is to move, the reply is over once the next move number appears
+            stop = [f" {board.fullmove_number + 1}.", "\n"]
+            next_text = self.make_request(pgn_to_query, num_tokens, temperature=self.config['temperature'], model=self.model, ignore_cache = not self.use_cache, stop=stop, early_stop=True)
+            if next_text[:2] == "-O":
+                # The model continued an "O" it assumed was already there; read it as castling instead of asking again
+                next_text = "O" + next_text
+        else:
+            next_text = self.make_request(pgn_to_query, num_tokens, temperature=self.config['temperature'], model=self.model, ignore_cache = not self.use_cache)
+            if next_text[:2] == "-O":
+                next_text = self.make_request(pgn_to_query+" ", num_tokens, temperature=self.config['temperature'], model=self.model, ignore_cache = not self.use_cache)
 
         if conversation:
             conversation.send_message("spectator", f"Received reply of '{next_text}'")
 
-        next_moves = self.try_moves(board, next_text)
+        return self.try_moves(board, next_text)
+
+    def get_best_move(self, board, num_tokens=None, conversation=None, header=None):
+        next_moves = self.get_continuation(board, num_tokens, conversation, lookahead=False, header=header)
 
         if len(next_moves) == 0:
-            conversation.send_message("player", "Tried to make an invalid move.")
-            conversation.send_message("spectator", "Tried to make an invalid move.")
+            if conversation:
+                conversation.send_message("player", "Tried to make an invalid move.")
+                conversation.send_message("spectator", "Tried to make an invalid move.")
             return None
 
         if conversation:
@@ -100,12 +379,108 @@ class ChessLLM:
 
         return next_moves[0]
 
-    @cachier()
-    def make_request(self, content, num_tokens, temperature, model="gpt-3.5-turbo-instruct", **kwargs):
+    def get_move_distribution(self, board, top_k=DEFAULT_TOP_K, num_tokens=None):
+        """
+        The model's distribution over the legal moves of the position, {san: probability}, from a single
+        request for the top_k logprobs of every token of the (greedy) reply; see fold_move_distribution.
+        """
+        pgn_to_query = self.get_query_pgn(board)
+        if pgn_to_query is None:
+            return {}
+        if num_tokens is None:
+            num_tokens = self.config.get('num_move_tokens', MOVE_TOKENS)
+        steps = self.make_logprobs_request(pgn_to_query, num_tokens, top_k, model=self.model, ignore_cache = not self.use_cache)
+        return fold_move_distribution(board, steps)
+
+    def make_logprobs_request(self, content, num_tokens, top_k, model="gpt-3.5-turbo-instruct", ignore_cache=False):
+        """Greedy reply with its top_k alternatives per token, as parsed by parse_top_logprobs (cached as JSON)."""
+        assert self.backend == "online", "The batch backend only collects plain completions"
+        use_cache = self.cache is not None and not ignore_cache
+        options = {"top_logprobs": top_k}
+        if use_cache:
+            cached = self.cache.get(model, content, num_tokens, 0, **options)
+            if cached is not None:
+                return json.loads(cached)
+
+        def call():
+            print("Not using cache")
+            if model.startswith("BlueSunflower"):
+                steps = parse_top_logprobs(self.local_client().complete(content, num_tokens, 0, logprobs=top_k))
+            else:
+                response = completion(model, messages=[{"role": "user", "content": content}],
+                                      max_tokens=num_tokens, temperature=0, logprobs=True, top_logprobs=top_k)
+                steps = parse_top_logprobs(_field(response["choices"][0], "logprobs"))
+            if use_cache:
+                self.cache.put(model, content, num_tokens, 0, json.dumps(steps), **options)
+            return steps
+
+        return self.flights.do(cache_key(model, content, num_tokens, 0, **options), call)
+
+    def make_request(self, content, num_tokens, temperature, model="gpt-3.5-turbo-instruct", ignore_cache=False, stop=None, early_stop=False, **kwargs):
         # kwargs are here for compatibility with local model calls through fastapi
-        print("Not using cache")
-        if model.startswith("BlueSunflower"):
-            raise NotImplementedError("Pythia chess is not supported yet")
+        use_cache = self.cache is not None and not ignore_cache
+        options = {"stop": stop, "early_stop": early_stop or None}
+        if use_cache:
+            cached = self.cache.get(model, content, num_tokens, temperature, **options)
+            if cached is not None:
+                return cached
+
+        if self.backend == "batch":
+            key = cache_key(model, content, num_tokens, temperature, **options)
+            self.pending[key] = {"model": model, "content": content, "num_tokens": num_tokens,
+                                 "temperature": temperature, "options": options}
+            raise PendingRequest(key)
 
-        response = completion(model, messages=[{"role": "user", "content": content}], **{"max_tokens": num_tokens, "temperature": temperature})
-        return response["choices"][0]["message"]["content"]
+        def call():
+            print("Not using cache")
+            extra = {"stop": stop} if stop else {}
+            messages = [{"role": "user", "content": content}]
+            if model.startswith("BlueSunflower"):
+                # served locally (see local_backend.py); the server applies the stop sequences
+                text = self.local_client().complete(content, num_tokens, temperature, stop=stop)["text"]
+            elif early_stop:
+                text = self._stream_first_move(model, messages, num_tokens, temperature, extra)
+            else:
+                response = completion(model, messages=messages, **{"max_tokens": num_tokens, "temperature": temperature}, **extra)
+                text = response["choices"][0]["message"]["content"]
+            if use_cache:
+                self.cache.put(model, content, num_tokens, temperature, text, **options)
+            return text
+
+        # Identical requests in flight at the same time get the same answer, unless we want independent samples
+        if use_cache or temperature == 0:
+            return self.flights.do(cache_key(model, content, num_tokens, temperature, **options), call)
+        return call()
+
+    def local_client(self):
+        """Client for locally served models (config["local_url"]); concurrent requests are micro-batched."""
+        with self._local_client_lock:
+            if self._local_client is None:
+                self._local_client = LocalModelClient(self.config.get("local_url", DEFAULT_LOCAL_URL),
+                                                      max_batch=self.config.get("local_max_batch", 32),
+                                                      max_wait=self.config.get("local_max_wait", 0.01),
+                                                      timeout=self.config.get("local_timeout", 300))
+            return self._local_client
+
+    async def make_request_async(self, *args, **kwargs):
+        """make_request for async tasks; identical requests are still merged with those from threads."""
+        return await asyncio.to_thread(self.make_request, *args, **kwargs)
+
+    def stats(self):
+        stats = {"upstream_calls": self.flights.calls, "coalesced": self.flights.saved}
+        if self.cache is not None:
+            stats.update({f"cache_{k}": v for k, v in self.cache.stats().items()})
+        return stats
+
+    def _stream_first_move(self, model, messages, num_tokens, temperature, extra):
+        """Stream the reply and cancel it as soon as it contains one complete move."""
+        response = completion(model, messages=messages, stream=True, **{"max_tokens": num_tokens, "temperature": temperature}, **extra)
+        text = ""
+        for chunk in response:
+            text += chunk.choices[0].delta.content or ""
+            if FIRST_MOVE_COMPLETE.match(text):
+                break
+        close = getattr(response, "close", None)
+        if close is not None:
+            close()
+        return text
@@ -0,0 +1,101 @@
+"""
+On-disk index from Lichess game id to the byte offset of the game in a decompressed monthly PGN dump.
+
+The index is two .npy files next to the PGN: the sorted fixed-width game ids, and the uint64 offsets
+(of the game's [Site line, as fetch_game_moves expects) in the same order.
+Both are memory-mapped, so opening an index is instant and a lookup is a binary search that only
+touches a few pages, instead of loading a dict with every game of the month into memory.
+Each monthly batch has its own index, built once; adding a batch only indexes the new dump.
+"""
+
+import os
+import re
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+KEY_WIDTH = 8  # Lichess game ids are 8 characters
+SITE_PATTERN = re.compile(rb'\[Site "https://lichess.org/([a-zA-Z0-9]+)"]')
+
+
+def index_paths(pgn_filename):
+    pgn_filename = Path(pgn_filename)
+    return (pgn_filename.with_name(pgn_filename.name + ".idx.keys.npy"),
+            pgn_filename.with_name(pgn_filename.name + ".idx.offsets.npy"))
+
+
+def build_game_index(pgn_filename):
+    """Scan the PGN file once and write its index files. Returns the number of games indexed."""
+    keys = bytearray()
+    offsets = array("Q")
+    skipped = 0
+
+    with open(pgn_filename, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.startswith(b"[Site "):
+                match = SITE_PATTERN.match(line)
+                if match:
+                    game_id = match.group(1)
+                    if len(game_id) == KEY_WIDTH:
+                        keys += game_id
+                        offsets.append(offset)
+                    else:
+                        skipped += 1
+            offset += len(line)
+
+    if skipped:
+        print(f"Skipped {skipped} games with ids that are not {KEY_WIDTH} characters long")
+
+    keys = np.frombuffer(bytes(keys), dtype=f"S{KEY_WIDTH}")
+    offsets = np.frombuffer(offsets.tobytes(), dtype=np.uint64)
+    order = np.argsort(keys, kind="stable")
+
+    for path, data in zip(index_paths(pgn_filename), (keys[order], offsets[order])):
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp, path)
+    return len(keys)
+
+
+class GameIndex:
+    """Read-only, dict-like view of a game index: `game_id in index`, `index[game_id]`."""
+
+    def __init__(self, pgn_filename):
+        keys_path, offsets_path = index_paths(pgn_filename)
+        self.keys = np.load(keys_path, mmap_mode="r")
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+
+    @classmethod
+    def load_or_build(cls, pgn_filename):
+        """Open the index of a PGN file, building it first if it is missing or older than the PGN."""
+        keys_path, offsets_path = index_paths(pgn_filename)
+        pgn_mtime = os.path.getmtime(pgn_filename)
+        if not all(p.exists() and os.path.getmtime(p) >= pgn_mtime for p in (keys_path, offsets_path)):
+            print("Indexing", pgn_filename)
+            n = build_game_index(pgn_filename)
+            print(f"Indexed {n} games")
+        return cls(pgn_filename)
+
+    def get(self, game_id, default=None):
+        key = game_id.encode() if isinstance(game_id, str) else game_id
+        if len(key) != KEY_WIDTH:
+            return default
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return int(self.offsets[i])
+        return default
+
+    def __contains__(self, game_id):
+        return self.get(game_id) is not None
+
+    def __getitem__(self, game_id):
+        offset = self.get(game_id)
+        if offset is None:
+            raise KeyError(game_id)
+        return offset
+
+    def __len__(self):
+        return len(self.keys)
@@ -20,12 +20,17 @@ import chess.pgn
 import io
 import csv
 import os
-import re
-import pickle
+import itertools
+import multiprocessing
+import requests
+import zstandard
 from pathlib import Path
+from game_index import GameIndex, SITE_PATTERN
 
 
 DATA_DIR = Path("/data/chess-data/lichess_puzzles")  # Set the desired path to the data folder
+STREAM_CHUNK_SIZE = 1 << 24  # 16MB reads from the compressed archive
+DROP_CACHE_EVERY = 1 << 28  # drop already-read pages of the archive from the page cache every 256MB
 
 def download_and_decompress(url, path):
     # Download to DATA_DIR, not here
@@ -55,24 +60,100 @@ def download_and_decompress(url, path):
 
 
 
+def open_archive(source):
+    """
+    Open a .zst archive for streaming, either a local file or a URL.
+    Returns the raw (compressed) file object; nothing is written to disk.
+    """
+    source = str(source)
+    if source.startswith("http://") or source.startswith("https://"):
+        response = requests.get(source, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response.raw
+    return open(source, "rb")
+
+def iter_zst_lines(source, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield the decompressed lines (as bytes) of a .zst archive without materializing the decompressed file.
+    For local archives, the pages that have been read are periodically dropped from the page cache.
+    """
+    # Lichess dumps are compressed with --long, which needs a large window
+    dctx = zstandard.ZstdDecompressor(max_window_size=2**31)
+    with open_archive(source) as fh:
+        can_fadvise = hasattr(os, "posix_fadvise") and hasattr(fh, "fileno") and isinstance(source, (str, Path)) and os.path.exists(source)
+        if can_fadvise:
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        dropped = 0
+        with dctx.stream_reader(fh, read_size=chunk_size) as reader:
+            for i, line in enumerate(io.BufferedReader(reader, buffer_size=chunk_size)):
+                yield line
+                if can_fadvise and i % 100000 == 0:
+                    pos = fh.tell()
+                    if pos - dropped > DROP_CACHE_EVERY:
+                        os.posix_fadvise(fh.fileno(), 0, pos, os.POSIX_FADV_DONTNEED)
+                        dropped = pos
+
+def iter_games(lines, offset=0):
+    """
+    Group PGN lines (bytes) into game records. Yields (offset, record), where offset is the
+    byte offset of the record's [Event line in the decompressed stream.
+    """
+    start = offset
+    record = []
+    for line in lines:
+        if line.startswith(b"[Event ") and record:
+            yield start, b"".join(record)
+            record = []
+            start = offset
+        record.append(line)
+        offset += len(line)
+    if record:
+        yield start, b"".join(record)
+
+def game_id_of(record):
+    match = SITE_PATTERN.search(record)
+    return match.group(1).decode() if match else None
+
+def split_ranges(filename, num_ranges):
+    """
+    Split a PGN file into about num_ranges byte ranges [start, end), each starting at an [Event line.
+    """
+    size = os.path.getsize(filename)
+    cuts = [0]
+    with open(filename, "rb") as f:
+        for i in range(1, num_ranges):
+            pos = max(size * i // num_ranges, cuts[-1])
+            f.seek(pos)
+            buf = b""
+            while True:
+                chunk = f.read(1 << 16)
+                if not chunk:
+                    pos = size
+                    break
+                buf += chunk
+                found = buf.find(b"\n[Event ")
+                if found >= 0:
+                    pos += found + 1
+                    break
+                # keep the tail in case the marker straddles two chunks
+                pos += len(buf) - 8
+                buf = buf[-8:]
+            if pos > cuts[-1]:
+                cuts.append(pos)
+    cuts.append(size)
+    return [(start, end) for start, end in zip(cuts, cuts[1:]) if end > start]
+
+def iter_range_lines(filename, start, end):
+    with open(filename, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            yield line
+            pos += len(line)
 
-def generate_mapping(filename):
-    mapping = {}
-
-    # Regular expression pattern to match the game ID from the Site URL
-    site_pattern = re.compile(r'\[Site "https://lichess.org/([a-zA-Z0-9]+)"]')
-
-    # Open the file in binary mode to compute byte offsets
-    with open(filename, 'rb') as f:
-        line = f.readline()
-        while line:
-            match = site_pattern.search(line.decode('utf-8'))
-            if match:
-                current_game_id = match.group(1)
-                mapping[current_game_id] = f.tell() - len(line)  # Get the starting byte offset of this line
-            line = f.readline()
-
-    return mapping
 
 def fetch_game_moves(filename, game_id, offset):
     moves = []
@@ -90,56 +171,132 @@ def convert_pgn_to_game(pgn_moves):
         return None
     return game
 
-def process_puzzles(puzzles_filename, games_filename, mapping ):
-    extracted_puzzles = []
-
+def load_puzzles(puzzles_filename):
+    """
+    Read the Lichess puzzle CSV into a dict game_id -> list of (row_index, uid, rating, move_num, uci_moves).
+    """
+    puzzles = {}
     with open(puzzles_filename, 'r') as f:
         reader = csv.reader(f)
         next(reader)
-        for row in reader:
+        for row_index, row in enumerate(reader):
             game_url, uci_moves = row[8], row[2].split()
             game_id = game_url.split('.org/')[1]
             move_num = int(game_url.split('#')[-1])
             game_id = game_id.split("/")[0].split("#")[0]
             rating = int(row[3])
+            puzzles.setdefault(game_id, []).append((row_index, row[0], rating, move_num, uci_moves))
+    return puzzles
+
+def board_to_movetext(board):
+    return str(chess.pgn.Game().from_board(board)).split("\n")[-1][:-2]
+
+def extract_puzzle(game, move_num, uci_moves):
+    """
+    Play the game up to the puzzle position and convert the UCI solution to SAN.
+    Returns (movetext, solution), or None if the solution doesn't fit the game.
+    """
+    board = game.board()
+
+    # only replay the moves up to the puzzle, not the whole mainline
+    for move in itertools.islice(game.mainline_moves(), move_num):
+        board.push(move)
+
+    new_board = board.copy()
+
+    try:
+        solution = []
+        for move in uci_moves[1:]:
+            m = chess.Move.from_uci(move)
+            solution.append(new_board.san(m))
+            new_board.push(m)
+    except:
+        print("Board import failed")
+        return None
+    return board_to_movetext(board), solution
 
-            if game_id in mapping:
-                pgn = fetch_game_moves(games_filename, game_id, mapping[game_id])
-                game = convert_pgn_to_game(pgn)
-                if game is None: continue
-
-                board = game.board()
-
-                for move in list(game.mainline_moves())[:move_num]:
-                    board.push(move)
-
-                new_board = board.copy()
-
-                try:
-                    solution = []
-                    for move in uci_moves[1:]:
-                        m = chess.Move.from_uci(move)
-                        solution.append(new_board.san(m))
-                        new_board.push(m)
-                except:
-                    print("Board import failed")
-                    continue
+def extract_from_records(records, wanted):
+    """
+    Extract the puzzles of the wanted games (game_id -> puzzles, as from load_puzzles) from (offset, record) pairs.
+    Only records whose game id is wanted are parsed.
+    """
+    extracted_puzzles = []
+    for offset, record in records:
+        game_id = game_id_of(record)
+        if game_id not in wanted:
+            continue
+        game = convert_pgn_to_game(record.decode("utf-8"))
+        if game is None: continue
+
+        for row_index, uid, rating, move_num, uci_moves in wanted[game_id]:
+            extracted = extract_puzzle(game, move_num, uci_moves)
+            if extracted is None: continue
+            extracted_puzzles.append((row_index, uid, rating, *extracted))
+    return extracted_puzzles
+
+def write_pgn_puzzles(extracted_puzzles, filename):
+    """Write (row_index, uid, rating, movetext, solution) tuples, in the order of the puzzle file."""
+    with open(filename, "w") as f:
+        writer = csv.writer(f)
+        for row_index, uid, rating, movetext, solution in sorted(extracted_puzzles, key=lambda x: x[0]):
+            writer.writerow((uid, rating, movetext, " ".join(solution)))
 
-                extracted_puzzles.append((row[0],
-                                          rating,
-                                         board,
-                                         solution,
-                ))
-                print(len(extracted_puzzles))
+def process_puzzles(puzzles_filename, games_filename, mapping ):
+    """mapping is a GameIndex (or any dict-like game_id -> offset)."""
+    extracted_puzzles = []
 
-    with open(os.path.join(games_filename.parent, "pgn_puzzles.csv"), "w") as f:
-        writer = csv.writer(f)
-        for uid, rating, board, solution in extracted_puzzles:
-            writer.writerow((uid, rating,
-                             str(chess.pgn.Game().from_board(board)).split("\n")[-1][:-2],
-                             " ".join(solution)))
+    for game_id, puzzles in load_puzzles(puzzles_filename).items():
+        if game_id not in mapping:
+            continue
+        pgn = fetch_game_moves(games_filename, game_id, mapping[game_id])
+        game = convert_pgn_to_game(pgn)
+        if game is None: continue
+
+        for row_index, uid, rating, move_num, uci_moves in puzzles:
+            extracted = extract_puzzle(game, move_num, uci_moves)
+            if extracted is None: continue
+            extracted_puzzles.append((row_index, uid, rating, *extracted))
+            print(len(extracted_puzzles))
+
+    write_pgn_puzzles(extracted_puzzles, os.path.join(games_filename.parent, "pgn_puzzles.csv"))
+
+def process_puzzles_stream(puzzles_filename, archive, output_dir):
+    """
+    Same as process_puzzles, but reads the games straight from the .zst archive (a path or a URL),
+    in a single pass, without decompressing it to disk or building a mapping.
+    """
+    wanted = load_puzzles(puzzles_filename)
+    extracted_puzzles = extract_from_records(iter_games(iter_zst_lines(archive)), wanted)
+    print(f"Extracted {len(extracted_puzzles)} puzzles")
+    write_pgn_puzzles(extracted_puzzles, os.path.join(output_dir, "pgn_puzzles.csv"))
+
+_wanted = None
+
+def _init_scan_worker(wanted):
+    global _wanted
+    _wanted = wanted
+
+def _scan_range(args):
+    filename, start, end = args
+    return extract_from_records(iter_games(iter_range_lines(filename, start, end), offset=start), _wanted)
+
+def process_puzzles_scan(puzzles_filename, games_filename, num_workers=None):
+    """
+    Same as process_puzzles, but joins the puzzles with the games in one sequential scan of the dump,
+    split into [Event-aligned byte ranges that are scanned by a pool of processes.
+    """
+    num_workers = num_workers or os.cpu_count()
+    wanted = load_puzzles(puzzles_filename)
+    # more ranges than workers, so that a slow range doesn't hold up the rest
+    ranges = split_ranges(games_filename, num_workers * 4)
 
+    extracted_puzzles = []
+    with multiprocessing.Pool(num_workers, initializer=_init_scan_worker, initargs=(wanted,)) as pool:
+        for i, extracted in enumerate(pool.imap_unordered(_scan_range, [(games_filename, start, end) for start, end in ranges])):
+            extracted_puzzles.extend(extracted)
+            print(f"Scanned {i + 1}/{len(ranges)} ranges, {len(extracted_puzzles)} puzzles")
 
+    write_pgn_puzzles(extracted_puzzles, os.path.join(games_filename.parent, "pgn_puzzles.csv"))
 
 
 
@@ -149,9 +306,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", "-d", help="Name of the data directory", default="/data/chess-data/lichess_puzzles")
     parser.add_argument("--batches", "-b", nargs='+', help="Name of the batch", default=["2014-06"])
+    parser.add_argument("--stream", action="store_true", help="Read the games directly from the .zst archive (or its URL, if not downloaded) without decompressing it to disk")
+    parser.add_argument("--use_index", action="store_true", help="Look up each puzzle's game through the game-offset index instead of scanning the dump once")
+    parser.add_argument("--num_workers", "-j", type=int, default=None, help="Number of processes scanning the dump (default: all cores)")
     args = parser.parse_args()
 
-    global DATA_DIR
     DATA_DIR = Path(args.data_dir)
 
     #batches = ["2023-05"]
@@ -163,13 +322,20 @@ if __name__ == "__main__":
         archive = f"lichess_db_standard_rated_{batch}.pgn"
         path = DATA_DIR / batch
         url_games = f"https://database.lichess.org/standard/{archive}.zst"
+        if args.stream:
+            path.mkdir(parents=True, exist_ok=True)
+            local_archive = path / f"{archive}.zst"
+            source = local_archive if local_archive.exists() else url_games
+            print("Streaming", source)
+            process_puzzles_stream(DATA_DIR / "lichess_db_puzzle.csv", source, path)
+            continue
         download_and_decompress(url_games, path)
 
 
         filename = path / archive
-        mapping = generate_mapping(filename)
-
-        with open(os.path.join(path, 'mapping.pickle'), 'wb') as f:
-            pickle.dump(mapping, f)
-        process_puzzles(puzzles_filename=DATA_DIR / "lichess_db_puzzle.csv", games_filename=filename, mapping=pickle.load(open(path / "mapping.pickle","rb")))
+        if args.use_index:
+            mapping = GameIndex.load_or_build(filename)
+            process_puzzles(puzzles_filename=DATA_DIR / "lichess_db_puzzle.csv", games_filename=filename, mapping=mapping)
+        else:
+            process_puzzles_scan(puzzles_filename=DATA_DIR / "lichess_db_puzzle.csv", games_filename=filename, num_workers=args.num_workers)
 
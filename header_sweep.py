@@ -0,0 +1,106 @@
+"""
+Sweep PGN headers: solve the same puzzles under every header of a grid of player names, Elo ratings
+and result tags (plus, optionally, no header at all), to see how the header affects the model's play.
+
+All (header, puzzle) pairs are scheduled in one solve_puzzles call, so they share the response cache,
+request coalescing and the worker pool. The outcome of every ply (see puzzle_solver.PLY_*) is stored
+in an int8 array indexed by [variant, puzzle, ply], saved to an .npz file with the headers and puzzle uids.
+"""
+
+import argparse
+import itertools
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import chessllm
+from puzzle_solver import solve_puzzles, board_from_pgn, PLY_NOT_REACHED, PLY_CORRECT
+
+DATA_DIR = Path("/data/chess-data/lichess_puzzles")
+
+
+def make_header(white=None, black=None, white_elo=None, black_elo=None, result=None):
+    """A PGN header with the given tags (None leaves a tag out); "" if no tags are given."""
+    tags = [("White", white), ("Black", black), ("Result", result), ("WhiteElo", white_elo), ("BlackElo", black_elo)]
+    lines = [f'[{name} "{value}"]' for name, value in tags if value is not None]
+    return "\n".join(lines) + "\n\n" if lines else ""
+
+
+def header_grid(names, elos, results, no_header=True):
+    """
+    Every combination of (white, black) names, (white_elo, black_elo) ratings and result tags;
+    None in any list means leaving those tags out.
+    """
+    headers = [make_header(*(name or (None, None)), *(elo or (None, None)), result)
+               for name, elo, result in itertools.product(names, elos, results)]
+    if no_header:
+        headers.append("")
+    return list(dict.fromkeys(headers))
+
+
+def parse_pairs(text):
+    """ "Magnus Carlsen/Garry Kasparov,none" -> [("Magnus Carlsen", "Garry Kasparov"), None] """
+    return [None if item == "none" else tuple(item.split("/")) for item in text.split(",")]
+
+
+def run_sweep(engine, headers, puzzles, num_workers=1, speculative=False):
+    """
+    Solve every (board, solution) puzzle under every header.
+    Returns (solved, plies): solved is a bool array [variant, puzzle], plies an int8 array [variant, puzzle, ply]
+    with the outcome of each of the model's plies (PLY_NOT_REACHED after the puzzle ended).
+    """
+    jobs = [(board.copy(), solution, header) for header in headers for board, solution in puzzles]
+    traces = [[] for _ in jobs]
+    results = solve_puzzles(engine, jobs, num_workers, speculative, traces=traces)
+
+    max_plies = max(((len(solution.split()) + 1) // 2 for _, solution in puzzles), default=0)
+    plies = np.full((len(headers), len(puzzles), max_plies), PLY_NOT_REACHED, dtype=np.int8)
+    for i, trace in enumerate(traces):
+        plies[i // len(puzzles), i % len(puzzles), :len(trace)] = trace
+    solved = np.array(results, dtype=bool).reshape(len(headers), len(puzzles))
+    return solved, plies
+
+
+def summarize(headers, solved, plies):
+    """Accuracy and per-ply accuracy of each header variant, best first."""
+    reached = plies != PLY_NOT_REACHED
+    ply_accuracy = (plies == PLY_CORRECT).sum(axis=1) / np.maximum(reached.sum(axis=1), 1)
+    order = np.argsort(-solved.mean(axis=1), kind="stable")
+    for v in order:
+        label = headers[v].replace("\n", " ").strip() or "(no header)"
+        per_ply = " ".join(f"{acc:.2f}" for acc in ply_accuracy[v])
+        print(f"acc {solved[v].mean():.3f}  plies [{per_ply}]  {label}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file_name", "-f", default=DATA_DIR / "pgn_puzzles.csv", help="Puzzle file (uid, rating, pgn, solution)")
+    parser.add_argument("--num_puzzles", "-n", type=int, default=200, help="Number of puzzles to solve under every header")
+    parser.add_argument("--names", default="Magnus Carlsen/Garry Kasparov,Anonymous/Anonymous,none", help="Comma-separated white/black name pairs; none leaves the tags out")
+    parser.add_argument("--elos", default="2900/2800,2000/2000,1200/1200,none", help="Comma-separated white/black Elo pairs; none leaves the tags out")
+    parser.add_argument("--results", default="none,1-0,0-1,1/2-1/2", help="Comma-separated result tags; none leaves the tag out")
+    parser.add_argument("--skip_no_header", action="store_true", help="Don't add the variant without any header")
+    parser.add_argument("--output", "-o", default=DATA_DIR / "header_sweep.npz", help="Where the results are saved")
+    parser.add_argument("--model", default="gpt-3.5-turbo-instruct", help="Model name")
+    parser.add_argument("--num_workers", "-j", type=int, default=8, help="Number of puzzles to solve concurrently")
+    parser.add_argument("--speculative", action="store_true", help="Play the moves of the model's continuation that match the solution without new requests")
+    parser.add_argument("--early_stop", action="store_true", help="Stop generating as soon as one move has been received")
+    args = parser.parse_args()
+
+    results = [None if item == "none" else item for item in args.results.split(",")]
+    headers = header_grid(parse_pairs(args.names), parse_pairs(args.elos), results, no_header=not args.skip_no_header)
+
+    df = pd.read_csv(args.file_name, header=None, names=['uid', 'rating', 'pgn', 'solution'], nrows=args.num_puzzles)
+    puzzles = [(board_from_pgn(row['pgn']), row['solution']) for _, row in df.iterrows()]
+    print(f"{len(headers)} header variants x {len(puzzles)} puzzles")
+
+    api_key = open("OPENAI_API_KEY").read().strip()
+    config = {"temperature": 0, "num_lookahead_tokens": 30, "early_stop": args.early_stop}
+    engine = chessllm.ChessLLM(api_key, config, model=args.model)
+    solved, plies = run_sweep(engine, headers, puzzles, args.num_workers, args.speculative)
+
+    np.savez_compressed(args.output, headers=np.array(headers), uids=df['uid'].to_numpy(dtype=str),
+                        ratings=df['rating'].to_numpy(), solved=solved, plies=plies)
+    summarize(headers, solved, plies)
+    print(f"Saved to {args.output}")
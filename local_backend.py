@@ -0,0 +1,203 @@
+"""
+Local backend for models we host ourselves (e.g. the BlueSunflower Pythia-chess models).
+
+LocalModelClient groups concurrent complete() calls (e.g. from many get_best_move calls in
+puzzle_solver's thread pool) into micro-batches: the first request of a batch waits at most max_wait
+seconds for up to max_batch others, and the batch is sent as one POST /generate over a pooled
+keep-alive connection. Each completion comes back with its tokens, per-token logprobs and top logprobs.
+If the server stalls, a call gives up after timeout seconds with an exception instead of hanging.
+
+The server side is `python local_backend.py --model EleutherAI/pythia-70m` (needs torch and transformers),
+or `python local_backend.py --stub` for a model-free stand-in that plays the first legal move.
+"""
+
+import json
+import queue
+import argparse
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_URL = "http://127.0.0.1:8000"
+MAX_BATCH = 32
+MAX_WAIT = 0.01  # seconds the first request of a batch waits for others
+TIMEOUT = 300  # seconds a complete() call waits for its completion (and a batch request for its response)
+CONNECT_TIMEOUT = 10
+
+
+def truncate_at_stop(text, stop):
+    for s in stop or []:
+        i = text.find(s)
+        if i >= 0:
+            text = text[:i]
+    return text
+
+
+class LocalModelClient:
+    def __init__(self, url=DEFAULT_URL, max_batch=MAX_BATCH, max_wait=MAX_WAIT, max_connections=4, timeout=TIMEOUT):
+        self.url = url.rstrip("/")
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+        self._queue = queue.Queue()
+        self._senders = ThreadPoolExecutor(max_workers=max_connections)
+        self.batches = 0
+        self.requests = 0
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+
+    def complete(self, prompt, max_tokens, temperature, stop=None, logprobs=0):
+        """
+        Returns {"text", "tokens", "token_logprobs", "top_logprobs"} for one prompt;
+        top_logprobs is a list (one per generated token) of {token: logprob} with up to `logprobs` entries.
+        Raises the error of the batch request, or TimeoutError if there is no completion within self.timeout seconds.
+        """
+        future = Future()
+        self._queue.put((prompt, (max_tokens, temperature, tuple(stop or ()), logprobs), future))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise TimeoutError(f"No completion from {self.url} within {self.timeout}s") from None
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Only requests with the same generation parameters can share a batch
+            groups = {}
+            for prompt, params, future in batch:
+                groups.setdefault(params, []).append((prompt, future))
+            for params, items in groups.items():
+                self._senders.submit(self._send, params, items)
+
+    def _send(self, params, items):
+        max_tokens, temperature, stop, logprobs = params
+        try:
+            response = self.session.post(f"{self.url}/generate", json={
+                "prompts": [prompt for prompt, _ in items],
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stop": list(stop),
+                "logprobs": logprobs,
+            }, timeout=(CONNECT_TIMEOUT, self.timeout))
+            response.raise_for_status()
+            completions = response.json()["completions"]
+            self.batches += 1
+            self.requests += len(items)
+            for (_, future), completion in zip(items, completions):
+                if not future.done():  # its caller may have given up waiting
+                    future.set_result(completion)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class StubModel:
+    """Model-free stand-in: replies with the first legal move of the prompt's position."""
+
+    def generate(self, prompts, max_tokens, temperature, logprobs):
+        from batch_backend import first_legal_move_reply
+        completions = []
+        for prompt in prompts:
+            text = first_legal_move_reply(prompt)
+            completions.append({"text": text, "tokens": [text], "token_logprobs": [0.0],
+                                "top_logprobs": [{text: 0.0}] if logprobs else []})
+        return completions
+
+
+class HFModel:
+    """Batched generation with a (small) Hugging Face causal LM, with per-token logprobs."""
+
+    def __init__(self, name, device="cpu"):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(name, padding_side="left")
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(name).to(device).eval()
+        self.device = device
+
+    def generate(self, prompts, max_tokens, temperature, logprobs):
+        torch = self.torch
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+        with torch.no_grad():
+            out = self.model.generate(**inputs, max_new_tokens=max_tokens, do_sample=temperature > 0,
+                                      temperature=temperature if temperature > 0 else None,
+                                      output_scores=True, return_dict_in_generate=True,
+                                      pad_token_id=self.tokenizer.pad_token_id)
+        generated = out.sequences[:, inputs["input_ids"].shape[1]:]
+        step_logprobs = [torch.log_softmax(score.float(), dim=-1) for score in out.scores]
+
+        completions = []
+        for i in range(len(prompts)):
+            tokens, token_logprobs, top_logprobs = [], [], []
+            for step, token_id in enumerate(generated[i].tolist()):
+                if token_id == self.tokenizer.pad_token_id and step > 0:
+                    break
+                tokens.append(self.tokenizer.decode([token_id]))
+                token_logprobs.append(step_logprobs[step][i, token_id].item())
+                if logprobs:
+                    values, ids = step_logprobs[step][i].topk(logprobs)
+                    top_logprobs.append({self.tokenizer.decode([t]): v for t, v in zip(ids.tolist(), values.tolist())})
+            completions.append({"text": "".join(tokens), "tokens": tokens,
+                                "token_logprobs": token_logprobs, "top_logprobs": top_logprobs})
+        return completions
+
+
+def serve(model, host="127.0.0.1", port=8000):
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep connections alive between batches
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self.send_error(404)
+                return
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with lock:
+                completions = model.generate(request["prompts"], request["max_tokens"],
+                                             request.get("temperature", 0), request.get("logprobs", 0))
+            for completion in completions:
+                completion["text"] = truncate_at_stop(completion["text"], request.get("stop"))
+            body = json.dumps({"completions": completions}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    print(f"Serving on http://{host}:{port}")
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="EleutherAI/pythia-70m", help="Hugging Face model to serve")
+    parser.add_argument("--stub", action="store_true", help="Serve the model-free stand-in instead of a model")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    serve(StubModel() if args.stub else HFModel(args.model, args.device), args.host, args.port)
@@ -6,11 +6,15 @@ Original_pgn: has header uid,rating,pgn,solution
 
 Create a new one with header uid,rating,pgn,proofgame,solution.
 Do not include columns where proofgame is None.
+
+With --position_index, the second game of a pair is instead a natural game from the Lichess dumps that
+reaches the puzzle position by a different move order (see position_index.py); proofgame_file is not needed.
 """
 
 import pandas as pd
 import argparse
 import os
+import chess
 
 def merge_files(data_dir, fen_file, proofgame_file, original_file, output_file):
     # Load the csv files
@@ -30,6 +34,32 @@ def merge_files(data_dir, fen_file, proofgame_file, original_file, output_file):
     # reorder so it's uid, rating, pgn, proofgame, solution
     merged_df = merged_df[['uid', 'rating', 'pgn', 'proofgame', 'solution']]
     merged_df.to_csv(output_file, index=False)
+    return merged_df
+
+def natural_pairs(data_dir, fen_file, original_file, output_file, indexes, max_orders=1):
+    """
+    Pair every puzzle with up to max_orders games from the position indexes that reach its position
+    by a different move order than the original game. Same columns as merge_files.
+    """
+    fens = pd.read_csv(os.path.join(data_dir, fen_file))
+    original_pgn = pd.read_csv(os.path.join(data_dir, original_file), header=None, names=['uid', 'rating', 'pgn', 'solution'])
+    merged_df = pd.merge(original_pgn, fens[['uid', 'FEN']], on='uid', how='inner')
+
+    rows = []
+    for _, row in merged_df.iterrows():
+        board = chess.Board(row['FEN'])
+        alternatives = []
+        for index in indexes:
+            for movetext in index.move_orders(board, limit=max_orders + 1):
+                if movetext != row['pgn'] and movetext not in alternatives:
+                    alternatives.append(movetext)
+        for movetext in alternatives[:max_orders]:
+            rows.append((row['uid'], row['rating'], row['pgn'], movetext, row['solution']))
+
+    pairs = pd.DataFrame(rows, columns=['uid', 'rating', 'pgn', 'proofgame', 'solution'])
+    pairs.to_csv(output_file, index=False)
+    print(f"{len(pairs)} natural pairs for {pairs['uid'].nunique()} of {len(merged_df)} puzzles")
+    return pairs
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -38,6 +68,18 @@ if __name__ == "__main__":
     parser.add_argument("--proofgame_file", "-pg", default="proofgame_pgns.csv", help="Name of the proofgame file")
     parser.add_argument("--original_file", "-o", default="pgn_puzzles.csv", help="Name of the original pgn file")
     parser.add_argument("--output", "-out", default="/data/chess-data/lichess_puzzles/pairs.csv", help="Name of the output file")
+    parser.add_argument("--position_index", nargs="+", default=None, help="Decompressed PGN dumps whose position indexes to take natural pairs from, instead of proof games")
+    parser.add_argument("--max_orders", type=int, default=1, help="With --position_index, the number of natural games to pair with each puzzle")
+    parser.add_argument("--binary_output", default=None, help="Also write the pairs as a binary dataset to this directory (see puzzle_dataset.py)")
     args = parser.parse_args()
 
-    merge_files(args.data_dir, args.pgn_file, args.proofgame_file, args.original_file, output_file=args.output)
+    if args.position_index:
+        from position_index import PositionIndex
+        indexes = [PositionIndex.load_or_build(pgn_file) for pgn_file in args.position_index]
+        pairs = natural_pairs(args.data_dir, args.fen_file, args.original_file, args.output, indexes, args.max_orders)
+    else:
+        pairs = merge_files(args.data_dir, args.fen_file, args.proofgame_file, args.original_file, output_file=args.output)
+
+    if args.binary_output:
+        from puzzle_dataset import convert_rows
+        convert_rows(pairs.to_dict("records"), args.binary_output)
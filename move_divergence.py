@@ -0,0 +1,147 @@
+"""
+Rank puzzle pairs (same position, original game vs. proof game) by how much the model's move
+distribution differs between the two games, as in "Possible next steps" in the README.
+
+For every pair, ChessLLM.get_move_distribution is queried on both games (one request each). The two
+distributions of a pair are laid out on the union of their moves, so all pairs fit in two dense arrays
+P, Q of shape (num_pairs, width + 1) (the last column is the OTHER_MOVE mass), saved with the move names
+to an .npz file. Jensen-Shannon and KL divergences are then computed for all pairs at once, and the
+pairs are written to a CSV report, most different first.
+"""
+
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+import chessllm
+from chessllm import OTHER_MOVE
+from puzzle_solver import board_from_pgn
+
+DATA_DIR = Path("/data/chess-data/lichess_puzzles")
+
+
+def collect_distributions(engine, boards, top_k=chessllm.DEFAULT_TOP_K, num_workers=1):
+    """Move distribution of every board, in input order."""
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(tqdm(executor.map(lambda board: engine.get_move_distribution(board, top_k), boards), total=len(boards)))
+
+
+def to_dense(distributions_a, distributions_b):
+    """
+    Lay out pairs of {san: probability} distributions on the union of each pair's moves.
+    Returns (P, Q, moves): P and Q have shape (n, width + 1), with the OTHER_MOVE mass in the last column,
+    and moves (n, width) holds the SAN of each column ("" for padding).
+    """
+    vocabularies = [sorted((a.keys() | b.keys()) - {OTHER_MOVE}) for a, b in zip(distributions_a, distributions_b)]
+    width = max((len(v) for v in vocabularies), default=0)
+    n = len(vocabularies)
+    P = np.zeros((n, width + 1))
+    Q = np.zeros((n, width + 1))
+    moves = np.full((n, width), "", dtype="<U8")
+    for i, (vocabulary, a, b) in enumerate(zip(vocabularies, distributions_a, distributions_b)):
+        moves[i, :len(vocabulary)] = vocabulary
+        P[i, :len(vocabulary)] = [a.get(move, 0.0) for move in vocabulary]
+        Q[i, :len(vocabulary)] = [b.get(move, 0.0) for move in vocabulary]
+        P[i, -1] = a.get(OTHER_MOVE, 0.0)
+        Q[i, -1] = b.get(OTHER_MOVE, 0.0)
+    return P, Q, moves
+
+
+def normalize(P):
+    total = P.sum(axis=1, keepdims=True)
+    return np.divide(P, total, out=np.zeros_like(P), where=total > 0)
+
+
+def kl_divergence(P, Q, eps=0.0):
+    """Row-wise KL(P || Q) in bits; with eps > 0, Q is smoothed so that the result is finite."""
+    P, Q = normalize(P), normalize(Q + eps)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = np.where(P > 0, P * np.log2(P / Q), 0.0)
+    return terms.sum(axis=1)
+
+
+def js_divergence(P, Q):
+    """Row-wise Jensen-Shannon divergence in bits (between 0 and 1); its square root is the JS distance."""
+    P, Q = normalize(P), normalize(Q)
+    M = (P + Q) / 2
+    return np.clip((kl_divergence(P, M) + kl_divergence(Q, M)) / 2, 0.0, 1.0)
+
+
+PAIR_COLUMNS = ["uid", "rating", "solution"]  # the columns of the pairs file that rank_pairs needs
+
+
+def save_distributions(path, df, P, Q, moves):
+    """Save the distributions together with the pair columns they belong to, row by row (uids may repeat)."""
+    columns = {column: df[column].to_numpy() for column in PAIR_COLUMNS}
+    columns["uid"] = columns["uid"].astype(str)
+    columns["solution"] = columns["solution"].astype(str)
+    np.savez_compressed(path, P=P, Q=Q, moves=moves, **columns)
+
+
+def load_distributions(path):
+    """The pairs (as a DataFrame with PAIR_COLUMNS) and P, Q and moves, as saved by save_distributions."""
+    data = np.load(path)
+    df = pd.DataFrame({column: data[column] for column in PAIR_COLUMNS})
+    return df, data["P"], data["Q"], data["moves"]
+
+
+def rank_pairs(df, P, Q, moves, eps=1e-6):
+    """The pairs in df (rows matching P and Q) with their divergences, sorted by JS distance, largest first."""
+    rows = np.arange(len(df))
+    top_a, top_b = P[:, :-1].argmax(axis=1), Q[:, :-1].argmax(axis=1)
+    best = np.array([solution.split()[0] for solution in df["solution"]])
+    is_best = np.hstack([moves == best[:, None], np.zeros((len(df), 1), dtype=bool)])
+    jsd = js_divergence(P, Q)
+
+    report = pd.DataFrame({
+        "uid": df["uid"].to_numpy(),
+        "rating": df["rating"].to_numpy(),
+        "js_distance": np.sqrt(jsd),
+        "jsd": jsd,
+        "kl_pgn_proofgame": kl_divergence(P, Q, eps),
+        "kl_proofgame_pgn": kl_divergence(Q, P, eps),
+        "top_pgn": moves[rows, top_a],
+        "p_top_pgn": P[rows, top_a],
+        "top_proofgame": moves[rows, top_b],
+        "p_top_proofgame": Q[rows, top_b],
+        "solution": best,
+        "p_solution_pgn": (P * is_best).sum(axis=1),
+        "p_solution_proofgame": (Q * is_best).sum(axis=1),
+        "other_pgn": P[:, -1],
+        "other_proofgame": Q[:, -1],
+    })
+    return report.sort_values("js_distance", ascending=False, kind="stable")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file_name", "-f", default=DATA_DIR / "pairs.csv", help="Pairs file (uid, rating, pgn, proofgame, solution)")
+    parser.add_argument("--num_pairs", "-n", type=int, default=None, help="Only use the first n pairs")
+    parser.add_argument("--distributions", default=DATA_DIR / "move_distributions.npz", help="Where the dense distributions are stored")
+    parser.add_argument("--output", "-o", default=DATA_DIR / "divergence_report.csv", help="Ranked report")
+    parser.add_argument("--reuse", action="store_true", help="Rank the stored distributions instead of querying the model")
+    parser.add_argument("--top_k", type=int, default=chessllm.DEFAULT_TOP_K, help="Alternatives per token to request")
+    parser.add_argument("--num_workers", "-j", type=int, default=8, help="Number of concurrent requests")
+    parser.add_argument("--model", default="gpt-3.5-turbo-instruct", help="Model name")
+    parser.add_argument("--show", type=int, default=20, help="Number of top pairs to print")
+    args = parser.parse_args()
+
+    if args.reuse:
+        df, P, Q, moves = load_distributions(args.distributions)
+    else:
+        df = pd.read_csv(args.file_name, nrows=args.num_pairs)
+        api_key = open("OPENAI_API_KEY").read().strip()
+        engine = chessllm.ChessLLM(api_key, {"temperature": 0}, model=args.model)
+        boards = [board_from_pgn(pgn) for pgn in df["pgn"]] + [board_from_pgn(pgn) for pgn in df["proofgame"]]
+        distributions = collect_distributions(engine, boards, args.top_k, args.num_workers)
+        P, Q, moves = to_dense(distributions[:len(df)], distributions[len(df):])
+        save_distributions(args.distributions, df, P, Q, moves)
+
+    report = rank_pairs(df, P, Q, moves)
+    report.to_csv(args.output, index=False)
+    print(f"Ranked {len(report)} pairs, mean JS distance {report['js_distance'].mean():.3f}; saved to {args.output}")
+    print(report.head(args.show).to_string(index=False))
@@ -13,36 +13,80 @@ Use argparse to input the file name and the output file name.
 
 import csv
 import os
-import io
 import argparse
+import itertools
+import multiprocessing
+from collections import deque
 from tqdm import tqdm
-import chess.pgn
+import chess
+
+CHUNK_SIZE = 10000  # rows per task
+
+def replay_movetext(pgn):
+    """
+    Play the moves of a plain movetext ("1. e4 e5 2. Nf3") without building a PGN game tree.
+    Like chess.pgn.read_game, stops at the first move that can't be played.
+    """
+    board = chess.Board()
+    for token in pgn.split():
+        if token[0].isdigit() or token == "*":
+            continue  # move numbers and results
+        try:
+            board.push_san(token)
+        except ValueError:
+            break
+    return board
+
+def convert_rows(rows):
+    return [(uid, rating, replay_movetext(pgn).fen(), solution) for uid, rating, pgn, solution in rows]
+
+def count_lines(filename):
+    with open(filename, "rb") as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 24), b""))
+
+def pgn_to_fen(input_file, output_file, num_entries=None, num_workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Convert the rows in chunks on a pool of processes. Rows are written in input order, and at most
+    2 * num_workers chunks are in flight, so memory is bounded by the chunk size.
+    """
+    num_workers = num_workers or os.cpu_count()
+    total = count_lines(input_file)
+    if num_entries is not None:
+        total = min(total, num_entries)
 
-def pgn_to_fen(input_file, output_file, num_entries=None):
     with open(input_file, "r") as f_in, open(output_file, "w") as f_out:
         reader = csv.reader(f_in)
+        if num_entries is not None:
+            reader = itertools.islice(reader, num_entries)
         writer = csv.writer(f_out)
-        
+        chunks = iter(lambda: list(itertools.islice(reader, chunk_size)), [])
+
         # write header
         writer.writerow(("uid", "rating", "FEN", "solution"))
-        for i, row in tqdm(enumerate(reader)):
-            if num_entries is not None and i >= num_entries:
-                break
-            uid, rating, pgn, solution = row
-            game = chess.pgn.read_game(io.StringIO(pgn))
-            board = game.board()
-            for move in game.mainline_moves():
-                board.push(move)
-            fen = board.fen()
-
-            writer.writerow((uid, rating, fen, solution))
+        with tqdm(total=total) as progress:
+            if num_workers <= 1:
+                for chunk in chunks:
+                    writer.writerows(convert_rows(chunk))
+                    progress.update(len(chunk))
+                return
+            with multiprocessing.Pool(num_workers) as pool:
+                in_flight = deque()
+                for chunk in itertools.chain(chunks, [None]):
+                    if chunk is not None:
+                        in_flight.append(pool.apply_async(convert_rows, (chunk,)))
+                    while in_flight and (chunk is None or len(in_flight) >= 2 * num_workers):
+                        rows = in_flight.popleft().get()
+                        writer.writerows(rows)
+                        progress.update(len(rows))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_file", "-i", help="Name of the input file", default="/data/chess-data/lichess_puzzles/pgn_puzzles.csv")
     parser.add_argument("--output_file", "-o", help="Name of the output file", default="/data/chess-data/lichess_puzzles/fen_puzzles.csv")
     parser.add_argument("--num_entries", "-n", type=int, help="Number of entries to process (if not given, process all)", default=None)
+    parser.add_argument("--num_workers", "-j", type=int, help="Number of processes (default: all cores)", default=None)
+    parser.add_argument("--chunk_size", type=int, help="Rows per task", default=CHUNK_SIZE)
 
     args = parser.parse_args()
 
-    pgn_to_fen(args.input_file, args.output_file, args.num_entries)
+    pgn_to_fen(args.input_file, args.output_file, args.num_entries, args.num_workers, args.chunk_size)
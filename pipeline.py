@@ -0,0 +1,320 @@
+"""
+The whole workflow (generate_pgn_puzzles -> pgn_to_fen -> proofgame -> make_pairs_puzzles_dataset ->
+puzzle_pair_solve) as one streaming pipeline: every stage runs in its own thread and passes rows to
+the next stage through a queue as soon as they are produced, so e.g. texelutil starts on the first
+FENs while the games are still being scanned.
+
+Every stage has its own parallelism (--extract_workers, --fen_workers, --proofgame_workers, --solve_workers)
+and a durable checkpoint in the work directory:
+    extract.done        byte ranges (or whole streamed batches) of the dumps that have been scanned
+    pgn_puzzles.csv     extracted puzzles            (uid, rating, pgn, solution)
+    fen_puzzles.csv     their positions              (uid, rating, FEN, solution)
+    the ProofgameStore  proof games, keyed by position (see proofgame_store.py)
+    pairs.csv           puzzle pairs                 (uid, rating, pgn, proofgame, solution)
+    solved.csv          model results on both games  (uid, rating, ok_pgn, ok_proofgame)
+After a crash, the rows in the checkpoints are fed to the next stages again and only the missing
+work is done: scanned ranges are skipped, and converted, solved or paired rows are not redone.
+"""
+
+import os
+import csv
+import queue
+import argparse
+import itertools
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import generate_pgn_puzzles as gpp
+from generate_pgn_puzzles import (download_and_decompress, load_puzzles, split_ranges, iter_games, iter_zst_lines,
+                                  game_id_of, extract_from_records, _init_scan_worker, _scan_range)
+from pgn_to_fen import convert_rows
+from proofgame import ProofgameScheduler, move_01, FENS_PER_PROCESS, DATA_DIR as PROOFGAME_DATA_DIR
+from proofgame_store import ProofgameStore
+from proofgame_filter import prefilter
+
+DATA_DIR = Path("/data/chess-data/lichess_puzzles")
+PUZZLES_URL = "https://database.lichess.org/lichess_db_puzzle.csv.zst"
+DONE = object()  # end-of-stream marker passed through the queues
+STREAM_CHUNK = 256  # wanted game records per task when streaming an archive
+# The pools are created from stage threads while other threads run; forking then could copy a lock
+# (e.g. stdout's) in its held state into a child, so pool processes are forked from a clean server instead
+MP_CONTEXT = multiprocessing.get_context("forkserver")
+
+
+class CsvCheckpoint:
+    """
+    Append-only CSV output of a stage. Rows are flushed as they are written; after a restart, the
+    rows already written are in self.rows (a partially written last line is dropped).
+    """
+
+    def __init__(self, path, header):
+        self.path = Path(path)
+        self.rows = []
+        if self.path.exists():
+            with open(self.path, "rb+") as f:
+                data = f.read()
+                end = data.rfind(b"\n") + 1
+                f.truncate(end)
+            with open(self.path, newline="") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                self.rows = [tuple(row) for row in reader if len(row) == len(header)]
+        self.keys = {row[0] for row in self.rows}
+        new = not self.path.exists() or self.path.stat().st_size == 0
+        self._file = open(self.path, "a", newline="")
+        self._writer = csv.writer(self._file)
+        self._lock = threading.Lock()
+        if new:
+            self._writer.writerow(header)
+            self._file.flush()
+
+    def append(self, row):
+        with self._lock:
+            self._writer.writerow(row)
+            self._file.flush()
+            self.keys.add(row[0])
+
+    def close(self):
+        self._file.close()
+
+
+def _init_extract_worker(puzzles_filename):
+    # every worker reads the puzzle CSV itself, instead of being sent a pickled copy of it (forkserver can't share memory)
+    _init_scan_worker(load_puzzles(puzzles_filename))
+
+
+def _extract_chunk(records):
+    return extract_from_records(records, gpp._wanted)
+
+
+def iter_extracted(batches, data_dir, workdir, num_workers):
+    """
+    Yield (uid, rating, pgn, solution) for the puzzles of every batch, scanning decompressed dumps in byte
+    ranges on a pool of processes (or streaming the .zst archive, if the dump isn't decompressed).
+    Finished ranges are recorded in workdir/extract.done and skipped when resuming.
+    """
+    download_and_decompress(PUZZLES_URL, data_dir)
+    puzzles_filename = data_dir / "lichess_db_puzzle.csv"
+    wanted = set(load_puzzles(puzzles_filename))  # here, only the game ids are needed
+    done_path = workdir / "extract.done"
+    done = set(done_path.read_text().split("\n")) if done_path.exists() else set()
+
+    with MP_CONTEXT.Pool(num_workers, initializer=_init_extract_worker, initargs=(puzzles_filename,)) as pool, \
+            open(done_path, "a") as done_file:
+        for batch in batches:
+            archive = f"lichess_db_standard_rated_{batch}.pgn"
+            filename = data_dir / batch / archive
+            if filename.exists():
+                ranges = [(start, end) for start, end in split_ranges(filename, num_workers * 4)
+                          if f"{batch} {start} {end}" not in done]
+                tasks = pool.imap_unordered(_scan_batch_range, [(batch, filename, start, end) for start, end in ranges])
+            elif f"{batch} stream" not in done:
+                local_archive = data_dir / batch / f"{archive}.zst"
+                source = local_archive if local_archive.exists() else f"https://database.lichess.org/standard/{archive}.zst"
+                print("Streaming", source)
+                records = ((offset, record) for offset, record in iter_games(iter_zst_lines(source)) if game_id_of(record) in wanted)
+                chunks = iter(lambda: list(itertools.islice(records, STREAM_CHUNK)), [])
+                tasks = itertools.chain(((None, extracted) for extracted in pool.imap(_extract_chunk, chunks)),
+                                        [(f"{batch} stream", [])])
+            else:
+                continue
+
+            for key, extracted in tasks:
+                for row_index, uid, rating, movetext, solution in extracted:
+                    yield uid, str(rating), movetext, " ".join(solution)
+                if key is not None:
+                    # only after all of the range's rows have been passed on
+                    done_file.write(key + "\n")
+                    done_file.flush()
+
+
+def _scan_batch_range(args):
+    batch, filename, start, end = args
+    return f"{batch} {start} {end}", _scan_range((filename, start, end))
+
+
+class Pipeline:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = Path(args.workdir)
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        self.pgn_puzzles = CsvCheckpoint(self.workdir / "pgn_puzzles.csv", ("uid", "rating", "pgn", "solution"))
+        self.fen_puzzles = CsvCheckpoint(self.workdir / "fen_puzzles.csv", ("uid", "rating", "FEN", "solution"))
+        self.pairs = CsvCheckpoint(self.workdir / "pairs.csv", ("uid", "rating", "pgn", "proofgame", "solution"))
+        self.solved = CsvCheckpoint(self.workdir / "solved.csv", ("uid", "rating", "ok_pgn", "ok_proofgame")) if args.solve else None
+        self.store = ProofgameStore(args.store)
+        self.pgn_by_uid = {row[0]: row[2] for row in self.pgn_puzzles.rows}
+        self.to_fen = queue.Queue()
+        self.to_proofgame = queue.Queue()
+        self.to_solve = queue.Queue()
+        self.errors = []
+
+    def _stage(self, name, fn, downstream):
+        def run():
+            try:
+                fn()
+            except BaseException as e:
+                print(f"Stage {name} failed: {e!r}")
+                self.errors.append(e)
+            finally:
+                downstream.put(DONE)
+        return threading.Thread(target=run, name=name)
+
+    def extract(self):
+        for row in self.pgn_puzzles.rows:
+            self.to_fen.put(row)
+        for row in iter_extracted(self.args.batches, Path(self.args.data_dir), self.workdir, self.args.extract_workers):
+            if row[0] not in self.pgn_puzzles.keys:
+                self.pgn_by_uid[row[0]] = row[2]
+                self.pgn_puzzles.append(row)
+                self.to_fen.put(row)
+
+    def convert(self):
+        """pgn_to_fen, in chunks of whatever rows are available, on a pool of processes."""
+        converted = {row[0]: row for row in self.fen_puzzles.rows}
+        slots = threading.BoundedSemaphore(2 * self.args.fen_workers)
+
+        def done(rows):
+            for row in rows:
+                self.fen_puzzles.append(row)
+                self.to_proofgame.put(row)
+            slots.release()
+
+        def failed(e):
+            self.errors.append(e)
+            slots.release()
+
+        with MP_CONTEXT.Pool(self.args.fen_workers) as pool:
+            finished = False
+            while not finished:
+                chunk = [self.to_fen.get()]
+                while len(chunk) < self.args.fen_chunk_size:
+                    try:
+                        chunk.append(self.to_fen.get_nowait())
+                    except queue.Empty:
+                        break
+                if chunk[-1] is DONE:
+                    finished = True
+                    chunk.pop()
+                todo = [row for row in chunk if row[0] not in converted]
+                for row in chunk:
+                    if row[0] in converted:
+                        self.to_proofgame.put(converted.pop(row[0]))
+                if todo:
+                    slots.acquire()
+                    pool.apply_async(convert_rows, (todo,), callback=done, error_callback=failed)
+            pool.close()
+            pool.join()
+
+    def proofgames(self):
+        """Start texelutil on every new position as soon as it arrives; pair puzzles as their proofs come in."""
+        waiting = {}  # canonical FEN -> puzzles waiting for its result
+        thread_ids = itertools.count()
+
+        def on_result(fen, pgn):
+            for uid, rating, _, solution in waiting.pop(fen, []):
+                if pgn:
+                    self.add_pair(uid, rating, pgn, solution)
+
+        def jobs():
+            while True:
+                try:
+                    row = self.to_proofgame.get_nowait()
+                except queue.Empty:
+                    yield None
+                    continue
+                if row is DONE:
+                    return
+                fen = move_01(row[2])
+                if fen in waiting:
+                    waiting[fen].append(row)
+                    continue
+                waiting[fen] = [row]
+                if self.store.is_done(fen, retry_failed=self.args.retry_failed):
+                    on_result(fen, self.store.proof(fen))
+                elif self.args.prefilter and not prefilter([fen])[0]:
+                    on_result(fen, None)
+                else:
+                    yield next(thread_ids), fen
+
+        scheduler = ProofgameScheduler(num_workers=self.args.proofgame_workers, timeout=self.args.timeout,
+                                       store=self.store, on_result=on_result, fens_per_process=self.args.fens_per_process)
+        scheduler.run(jobs())
+
+    def add_pair(self, uid, rating, proofgame, solution):
+        if uid in self.pairs.keys:
+            return
+        pgn = self.pgn_by_uid[uid]
+        row = (uid, rating, pgn, proofgame, solution)
+        self.pairs.append(row)
+        if self.solved is not None:
+            self.to_solve.put(row)
+
+    def solve(self):
+        """Solve both games of every pair as it arrives (puzzle_pair_solve)."""
+        from puzzle_solver import solve_puzzle, board_from_pgn
+        import chessllm
+        api_key = open("OPENAI_API_KEY").read().strip()
+        engine = chessllm.ChessLLM(api_key, {"temperature": 0, "num_lookahead_tokens": 30}, model=self.args.model)
+
+        def solve_pair(row):
+            uid, rating, pgn, proofgame, solution = row
+            ok_pgn = solve_puzzle(board_from_pgn(pgn), solution, engine)
+            ok_proofgame = solve_puzzle(board_from_pgn(proofgame), solution, engine)
+            self.solved.append((uid, rating, int(ok_pgn), int(ok_proofgame)))
+
+        with ThreadPoolExecutor(max_workers=self.args.solve_workers) as executor:
+            futures = []
+            for row in iter(self.to_solve.get, DONE):
+                if row[0] not in self.solved.keys:
+                    futures.append(executor.submit(solve_pair, row))
+            for future in futures:
+                future.result()
+
+    def run(self):
+        if self.solved is not None:
+            for row in self.pairs.rows:
+                self.to_solve.put(row)
+
+        stages = [self._stage("extract", self.extract, self.to_fen),
+                  self._stage("fen", self.convert, self.to_proofgame),
+                  self._stage("proofgame", self.proofgames, self.to_solve)]
+        if self.args.solve:
+            stages.append(self._stage("solve", self.solve, queue.Queue()))
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+
+        for checkpoint in (self.pgn_puzzles, self.fen_puzzles, self.pairs, self.solved):
+            if checkpoint is not None:
+                checkpoint.close()
+        print(f"{len(self.pgn_puzzles.keys)} puzzles, {len(self.pairs.keys)} pairs", end="")
+        print(f", {len(self.solved.keys)} solved pairs" if self.solved is not None else "")
+        print("Store:", self.store.counts())
+        if self.errors:
+            raise self.errors[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", "-d", default=DATA_DIR, help="Where the Lichess downloads are")
+    parser.add_argument("--workdir", default=DATA_DIR / "pipeline", help="Where the stage outputs and checkpoints are written")
+    parser.add_argument("--batches", "-b", nargs="+", default=["2014-06"], help="Monthly game dumps to take puzzles from")
+    parser.add_argument("--store", default=f"{PROOFGAME_DATA_DIR}/proofgames.sqlite", help="Proofgame store shared by all runs")
+    parser.add_argument("--extract_workers", type=int, default=os.cpu_count(), help="Processes scanning the game dumps")
+    parser.add_argument("--fen_workers", type=int, default=2, help="Processes converting PGNs to FENs")
+    parser.add_argument("--fen_chunk_size", type=int, default=1000, help="Most rows converted per task")
+    parser.add_argument("--proofgame_workers", type=int, default=64, help="texelutil processes to keep running")
+    parser.add_argument("--timeout", type=int, default=180, help="texelutil timeout per position in seconds")
+    parser.add_argument("--fens_per_process", type=int, default=FENS_PER_PROCESS, help="Most FENs given to one texelutil process")
+    parser.add_argument("--retry_failed", action="store_true", help="Also retry positions that previously timed out or were not solved")
+    parser.add_argument("--prefilter", action="store_true", help="Skip provably unreachable positions")
+    parser.add_argument("--solve", action="store_true", help="Also solve every pair with the model")
+    parser.add_argument("--solve_workers", type=int, default=8, help="Pairs solved concurrently")
+    parser.add_argument("--model", default="gpt-3.5-turbo-instruct", help="Model name")
+    args = parser.parse_args()
+
+    Pipeline(args).run()
@@ -0,0 +1,213 @@
+"""
+On-disk index from positions to the games of a decompressed monthly PGN dump that reach them, for finding
+natural games that arrive at the same position by different move orders.
+
+Every game is replayed up to max_ply half-moves, and the polyglot Zobrist hash of each position is recorded
+with the byte offset of the game's [Event line, the ply, and a hash of the sequence of positions that led
+to it (so that games with the same move order can be told apart without reading them). The dump is split
+into [Event-aligned byte ranges that are replayed by a pool of processes; each range's rows are sorted
+and written to disk as a run, and the runs are merged a block at a time, so memory use doesn't grow with
+the dump. The result is four .npy files next to the PGN (hashes sorted, the rest in the same order); like
+the game index, they are memory-mapped, so a lookup is a binary search, and only one game per distinct
+move order is read back from the dump.
+"""
+
+import os
+import re
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from array import array
+from pathlib import Path
+
+import chess
+import chess.polyglot
+import numpy as np
+
+from generate_pgn_puzzles import split_ranges, iter_range_lines, iter_games, board_to_movetext
+
+DEFAULT_MAX_PLY = 40
+COMMENT = re.compile(rb"\{[^}]*\}|\([^)]*\)")
+PATH_MULTIPLIER = 0x100000001B3  # FNV-1a style mixing of the position hashes along a game
+MASK = (1 << 64) - 1
+COLUMNS = (("hashes", np.uint64), ("offsets", np.uint64), ("plies", np.uint16), ("paths", np.uint64))
+ROW_BYTES = sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS)
+RANGE_BYTES = 1 << 28  # most PGN bytes replayed into one sorted run (its rows are held in memory)
+MERGE_MEMORY = 1 << 28  # bytes of rows held in memory while merging the runs
+
+
+def index_paths(pgn_filename):
+    pgn_filename = Path(pgn_filename)
+    return tuple(pgn_filename.with_name(f"{pgn_filename.name}.pos.{name}.npy") for name, _ in COLUMNS)
+
+
+def iter_sans(record):
+    """The SAN moves of a game record (bytes), without parsing it into a chess.pgn.Game."""
+    movetext = b" ".join(line for line in record.splitlines() if not line.startswith(b"["))
+    for token in COMMENT.sub(b" ", movetext).split():
+        # skip move numbers, results, NAGs and the unknown-result marker
+        if token[:1].isdigit() or token[:1] in (b"$", b"*"):
+            continue
+        yield token.decode().rstrip("!?")
+
+
+def replay(record, max_ply):
+    """Yield (ply, board) for the positions of a game after each of its first max_ply half-moves."""
+    board = chess.Board()
+    for ply, san in enumerate(iter_sans(record), 1):
+        if ply > max_ply:
+            break
+        try:
+            board.push_san(san)
+        except ValueError:
+            break
+        yield ply, board
+
+
+def _index_range(args):
+    """Replay a byte range of the dump and write its rows, sorted by hash, to run_dir. Returns (start, number of rows)."""
+    filename, start, end, max_ply, run_dir = args
+    hashes, offsets, plies, paths = array("Q"), array("Q"), array("H"), array("Q")
+    for offset, record in iter_games(iter_range_lines(filename, start, end), offset=start):
+        if b'[SetUp "1"]' in record:
+            continue  # doesn't start from the initial position
+        path = 0
+        for ply, board in replay(record, max_ply):
+            key = chess.polyglot.zobrist_hash(board)
+            path = ((path ^ key) * PATH_MULTIPLIER) & MASK
+            hashes.append(key)
+            offsets.append(offset)
+            plies.append(ply)
+            paths.append(path)
+    columns = [np.frombuffer(column.tobytes(), dtype=dtype) for column, (_, dtype) in zip((hashes, offsets, plies, paths), COLUMNS)]
+    order = np.argsort(columns[0], kind="stable")
+    for (name, _), column in zip(COLUMNS, columns):
+        np.save(run_dir / f"{start}.{name}.npy", column[order])
+    return start, len(order)
+
+
+def merge_runs(run_dir, runs, out_paths, memory=MERGE_MEMORY):
+    """
+    Merge the sorted runs [(start, number of rows)] in run_dir into the index files out_paths, holding about
+    memory bytes of rows at a time. Returns the number of rows.
+    """
+    total = sum(n for _, n in runs)
+    sources = [[np.load(run_dir / f"{start}.{name}.npy", mmap_mode="r") for name, _ in COLUMNS] for start, n in runs if n]
+    tmps = [path.with_name(path.name + ".tmp") for path in out_paths]
+    outputs = [np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=(total,)) for tmp, (_, dtype) in zip(tmps, COLUMNS)]
+    block = max(1, memory // ROW_BYTES // max(len(sources), 1))
+    positions = [0] * len(sources)
+    written = 0
+    while written < total:
+        # rows up to the smallest last hash of the runs' next blocks can't be preceded by any row still on disk
+        cutoff = min(source[0][min(pos + block, len(source[0])) - 1] for source, pos in zip(sources, positions) if pos < len(source[0]))
+        parts = []
+        for i, (source, pos) in enumerate(zip(sources, positions)):
+            end = pos + int(np.searchsorted(source[0][pos:pos + block], cutoff, side="right"))
+            parts.append([column[pos:end] for column in source])
+            positions[i] = end
+        columns = [np.concatenate([part[k] for part in parts]) for k in range(len(COLUMNS))]
+        order = np.argsort(columns[0], kind="stable")
+        for output, column in zip(outputs, columns):
+            output[written:written + len(order)] = column[order]
+        written += len(order)
+    for output in outputs:
+        output.flush()
+    del outputs
+    for tmp, path in zip(tmps, out_paths):
+        os.replace(tmp, path)
+    return total
+
+
+def build_position_index(pgn_filename, max_ply=DEFAULT_MAX_PLY, num_workers=None, memory=MERGE_MEMORY):
+    """Replay the games of the PGN file in parallel and write its position index. Returns the number of positions."""
+    num_workers = num_workers or os.cpu_count()
+    # more ranges than workers, so that a slow range doesn't hold up the rest, and small enough for a run to fit in memory
+    ranges = split_ranges(pgn_filename, max(num_workers * 4, -(-os.path.getsize(pgn_filename) // RANGE_BYTES)))
+    run_dir = Path(tempfile.mkdtemp(prefix=".pos_runs_", dir=Path(pgn_filename).resolve().parent))
+    try:
+        runs = []
+        with multiprocessing.Pool(num_workers) as pool:
+            tasks = [(pgn_filename, start, end, max_ply, run_dir) for start, end in ranges]
+            for i, run in enumerate(pool.imap(_index_range, tasks)):
+                runs.append(run)
+                print(f"Indexed {i + 1}/{len(ranges)} ranges")
+        return merge_runs(run_dir, runs, index_paths(pgn_filename), memory)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def read_record(f, offset):
+    """The game record (bytes) starting at offset of an open PGN file."""
+    f.seek(offset)
+    record = [f.readline()]
+    for line in f:
+        if line.startswith(b"[Event "):
+            break
+        record.append(line)
+    return b"".join(record)
+
+
+class PositionIndex:
+    """Read-only view of a position index: which games of the dump reach a position, and by which moves."""
+
+    def __init__(self, pgn_filename):
+        self.pgn_filename = pgn_filename
+        self.hashes, self.offsets, self.plies, self.paths = (np.load(path, mmap_mode="r") for path in index_paths(pgn_filename))
+
+    @classmethod
+    def load_or_build(cls, pgn_filename, max_ply=DEFAULT_MAX_PLY, num_workers=None):
+        """Open the index of a PGN file, building it first if it is missing or older than the PGN."""
+        pgn_mtime = os.path.getmtime(pgn_filename)
+        if not all(p.exists() and os.path.getmtime(p) >= pgn_mtime for p in index_paths(pgn_filename)):
+            print("Indexing positions of", pgn_filename)
+            n = build_position_index(pgn_filename, max_ply, num_workers)
+            print(f"Indexed {n} positions")
+        return cls(pgn_filename)
+
+    def _range(self, board):
+        key = np.uint64(chess.polyglot.zobrist_hash(board))
+        return np.searchsorted(self.hashes, key, side="left"), np.searchsorted(self.hashes, key, side="right")
+
+    def lookup(self, board):
+        """(offset, ply) of every indexed occurrence of the board's position."""
+        lo, hi = self._range(board)
+        return [(int(offset), int(ply)) for offset, ply in zip(self.offsets[lo:hi], self.plies[lo:hi])]
+
+    def move_orders(self, board, limit=None):
+        """
+        The distinct move orders (as movetext, like the pgn column of pgn_puzzles.csv) by which the games
+        of the dump reach the board's position, at most limit of them.
+        """
+        # the en passant square only counts if a capture is legal, as in the FEN of a puzzle
+        target = board._transposition_key()
+        lo, hi = self._range(board)
+        # one game per distinct move order
+        _, first = np.unique(self.paths[lo:hi], return_index=True)
+        orders = {}
+        with open(self.pgn_filename, "rb") as f:
+            for i in np.sort(first) + lo:
+                ply = int(self.plies[i])
+                for n, replayed in replay(read_record(f, int(self.offsets[i])), ply):
+                    # guard against hash collisions
+                    if n == ply and replayed._transposition_key() == target:
+                        orders.setdefault(tuple(replayed.move_stack), board_to_movetext(replayed))
+                if limit is not None and len(orders) >= limit:
+                    break
+        return list(orders.values())
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pgn_files", nargs="+", help="Decompressed monthly PGN dumps to index")
+    parser.add_argument("--max_moves", type=int, default=DEFAULT_MAX_PLY // 2, help="Index the positions of the first this many moves of every game")
+    parser.add_argument("--num_workers", "-j", type=int, default=None, help="Number of processes replaying games (default: all cores)")
+    args = parser.parse_args()
+
+    for pgn_file in args.pgn_files:
+        n = build_position_index(pgn_file, 2 * args.max_moves, args.num_workers)
+        print(f"{pgn_file}: indexed {n} positions")
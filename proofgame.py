@@ -2,15 +2,16 @@
  For a given FEN, we'll be using the texelutil proofgame CLI to generate a proof game.
  An example command is:
  echo "r6r/pp3pk1/5Rp1/n2pP1Q1/2pPp3/2P1P2q/PP1B3P/R5K1 w - - 0 1"" | texelutil proofgame -f -o outfile -rnd seed 2>debug 
- We'll be running multiple commands like this in parallel, so we'll need to make sure that the output files are unique.
- The general command is
- echo FEN | texelutil proofgame -f -o result_t_{thread_id}_ -rnd seed 2>debug_t_{thread_id}_
+ We run texelutil directly (no shell), writing a small batch of FENs to its stdin and reading its stdout through pipes.
+ Many processes run in parallel, so each one gets its own temporary directory for the intermediate
+ files (-o outfile gives outfile00, outfile01, outfile02, etc.), which is removed when the process ends.
 
- texelutil proofgame saves the output into a list of files: if -o outfile,
- then the output files are outfile00, outfile01, outfile02, etc.
- If successfuly solved, the last one contains the proof game in this format:
+ When a FEN is finished, texelutil prints its result line, which starts with the FEN:
  r6r/pp3pk1/5Rp1/n2pP1Q1/2pPp3/2P1P2q/PP1B3P/R5K1 w - - 0 1 legal: proof: g4 d5 f4 h5 gxh5 e5 Nh3 Bxh3 Bxh3 e4 Bd7+ Nxd7 h6 Ne5 fxe5 Rxh6 Nc3 Be7 Na4 Bc5 Nxc5 Rh8 Ne6 Qc8 Nd8 Qxd8 Kf1 Kf8 d4 c5 c3 g6 e3 c4 Bd2 Kg7 Qh5 Qd7 Qg5 Ne7 Kg1 Nc6 Rf1 Qe6 Rf6 Qh3 Kf2 Rh7 Ra1 Rhh8 Kg1 Na5
- Note that it contains the substring "legal: proof: ".
+ Note that it contains the substring "legal: proof: ". The line is parsed (and the proof game validated)
+ by a reader thread as soon as it appears, so there is no post-processing pass over result files.
+ Only "legal: proof:", "illegal:" and "invalid:" finish a FEN early; an "unknown:" status may still be
+ refined by a later pass, so it is only taken as the result once texelutil has exited.
 
  We time out each run after TIMEOUT seconds, which means some positions won't have a proof game, 
  so the last file will not have "legal: proof: ", but rather "unknown: kernel: " or something like that.
@@ -27,15 +28,22 @@ import os
 import io
 import argparse
 import subprocess
+import shutil
+import tempfile
 import re
 import chess
 import chess.pgn
 from pathlib import Path
 import pandas as pd
-from tqdm import tqdm
-from concurrent.futures import TimeoutError
-import multiprocessing
+from proofgame_store import ProofgameStore
+from proofgame_filter import prefilter, evaluate_prefilter
+from proofgame_queue import LeaseQueue, LeaseReporter, open_queue, serve_queue, DEFAULT_LEASE
+import signal
+import itertools
 import time
+import socket
+import threading
+from collections import Counter, deque
 
 # Add texelutil to the PATH
 TEXELUTIL_PATH = Path(".").resolve()
@@ -48,19 +56,20 @@ TEXELUTIL_RES_DIR = "./texel_temp_results"
 os.makedirs(TEXELUTIL_RES_DIR, exist_ok=True)
 MAX_THREADS = 64
 TIMEOUT = 180  # Timeout in seconds
+PROOF_LINE = re.compile(r"legal: proof: (.*)")
+STDBUF = ["stdbuf", "-oL"] if shutil.which("stdbuf") else []
+RESULT_LINE = re.compile(r"\b(legal|illegal|unknown|invalid):")  # a status texelutil gives a FEN
+FINAL_LINE = re.compile(r"\b(legal: proof|illegal|invalid):")  # a status later passes can't change, so the FEN is done
+FENS_PER_PROCESS = 8  # Most FENs given to one texelutil process, which then pays its startup once for all of them
+TRIVIAL_FEN = "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"  # solved at once, to time texelutil's startup
+POLL_INTERVAL = 0.2  # How often the scheduler checks on running texelutil jobs, in seconds
+REPORT_INTERVAL = 60  # How often the scheduler prints throughput, in seconds
 
 # List of FENs for testing whether the code works
 fens_test = ["r6r/pp3pk1/5Rp1/n2pP1Q1/2pPp3/2P1P2q/PP1B3P/R5K1 w - - 0 1", 
              "r6r/pp3pk1/5Rp1/n2pP1Q1/2pPp3/2P1P2q/PP1B3P/R5K1 w - - 0 1",
              "r1b3k1/pp3Rpp/3p1b2/2pN4/2P5/5Q1P/PPP3P1/4qNK1 w - - 0 1"]
 
-def check_contains_fen(fen, file):
-    if not os.path.exists(file):
-        return False
-    with open(file, "r") as f:
-        content = f.read()
-        return content.startswith(fen)
-
 def move_01(fen : str):
     """
     Replace the last two fields in the FEN (halfmove count for 50-move rule, full move count) with 0 and 1.
@@ -71,17 +80,416 @@ def move_01(fen : str):
     fen[5] = "1"
     return " ".join(fen)
 
-def run_command(fen, thread_id, force=False):
-    FIRST_FILE = f"{TEXELUTIL_RES_DIR}/result_t_{thread_id}_00"
-    if not force and os.path.exists(FIRST_FILE):
-        if check_contains_fen(fen, FIRST_FILE):
-            print(f"Thread {thread_id}: Already solved")
+def texelutil_args(output_prefix, seed=SEED):
+    return ["texelutil", "proofgame", "-f", "-o", output_prefix, "-rnd", str(seed)]
+
+def position_key(line : str):
+    """The first four FEN fields of a FEN or of one of texelutil's result lines, which identify the position."""
+    return " ".join(line.split()[:4])
+
+def result_lines(content : str):
+    """position_key -> status line, for every FEN in texelutil's output (or in one of its intermediate files)."""
+    return {position_key(line): line for line in content.splitlines() if RESULT_LINE.search(line)}
+
+class TexelJob:
+    """One FEN given to a TexelProcess. done is set once its result is in: self.pgn, or None if there is no valid proof."""
+
+    def __init__(self, thread_id, fen, seed=SEED, timeout=TIMEOUT):
+        self.thread_id = thread_id
+        self.fen = fen
+        self.seed = seed
+        self.timeout = timeout
+        self.pgn = None
+        self.done = threading.Event()
+        self.budget = None  # seconds its whole batch had (see TexelProcess)
+        self.elapsed = None  # seconds from the end of texelutil's startup to its result
+        self.timed_out = False
+        self.dropped = False  # another job found a proof for its position first
+        self.recorded = False
+
+class TexelProcess:
+    """
+    A texelutil process working on a small batch of FENs, all with the same seed. texelutil proofgame -f is a
+    filter that reads its whole input before it starts its passes, so the FENs are all written to its stdin,
+    which is then closed; starting texelutil (and initializing its tables) is paid for once per batch instead
+    of once per FEN. A reader thread parses its stdout as it arrives, and each job is done as soon as the
+    final status line of its FEN appears. A batch gets the sum of its jobs' timeouts, the time its FENs would
+    have had on processes of their own, so a single hard FEN can use more than its own timeout; that batch
+    budget is what each job records, and its elapsed time is counted from the end of texelutil's startup.
+    Intermediate -o files and the debug log go to a temporary directory that is removed by stop().
+    """
+
+    def __init__(self, jobs, startup=0.0):
+        self.jobs = jobs
+        self.seed = jobs[0].seed
+        self.timeout = sum(job.timeout for job in jobs)
+        self.startup = startup
+        for job in jobs:
+            job.budget = self.timeout
+        self.lock = threading.Lock()
+        self.killed = False
+        self.stopped = False
+        self.start = time.time()
+        self.workdir = tempfile.mkdtemp(prefix="texel_", dir=TEXELUTIL_RES_DIR)
+        with open(f"{self.workdir}/debug.log", "w") as log:
+            # line-buffered stdout, so results arrive as soon as they are printed
+            self.proc = subprocess.Popen(STDBUF + texelutil_args(f"{self.workdir}/result_", self.seed), stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=log, text=True, bufsize=1, start_new_session=True)
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+        try:
+            self.proc.stdin.write("".join(job.fen + "\n" for job in jobs))
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass  # texelutil died; the reader finishes the jobs when it sees the end of its output
+
+    def finished(self):
+        return all(job.done.is_set() for job in self.jobs)
+
+    def _settle(self, job, content, timed_out=False):
+        """Finish job with the result in content (None if there is none to parse)."""
+        with self.lock:
+            if job.done.is_set():
+                return
+            job.pgn = parse_result(content, job.fen, job.thread_id) if content is not None else None
+            job.timed_out = timed_out
+            job.elapsed = max(time.time() - self.start - self.startup, 0.0)
+            job.done.set()
+
+    def _read(self):
+        statuses = {}  # the latest "unknown:" status of each position, which later passes may still refine
+        for line in self.proc.stdout:
+            if FINAL_LINE.search(line):
+                for job in self.jobs:
+                    if position_key(job.fen) == position_key(line):
+                        self._settle(job, line)
+            elif RESULT_LINE.search(line):
+                statuses[position_key(line)] = line
+        if self.proc.wait() != 0:
+            if not self.killed:
+                print(f"texelutil exited with code {self.proc.returncode} on a batch of {len(self.jobs)} FENs")
+                for job in self.jobs:
+                    self._settle(job, None)
             return
-    command = f'echo "{fen}" | texelutil proofgame -f -o {TEXELUTIL_RES_DIR}/result_t_{thread_id}_ -rnd {SEED} 2>{DATA_DIR}/logs/debug_t_{thread_id}_.log'
+        # texelutil gave up on the FENs still waiting ("unknown:"), or only wrote their results to its files
+        files = result_lines(last_output(self.workdir))
+        for job in self.jobs:
+            key = position_key(job.fen)
+            self._settle(job, statuses.get(key) or files.get(key, ""))
+
+    def drop(self, job):
+        """Give up on a job whose position has already been solved elsewhere; texelutil still works on its batch."""
+        job.dropped = True
+        self._settle(job, None)
+
+    def stop(self, salvage=False):
+        """
+        Kill texelutil and remove its files. Jobs still waiting are finished as timed out; with salvage, they get
+        the proof game from the last intermediate file, if texelutil had found one.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        self.killed = True
+        if self.proc.poll() is None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.proc.wait()
+        self.reader.join()
+        for pipe in (self.proc.stdin, self.proc.stdout):
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+        files = result_lines(last_output(self.workdir)) if salvage else {}
+        for job in self.jobs:
+            self._settle(job, files.get(position_key(job.fen), "") if salvage else None, timed_out=True)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+def measure_startup(timeout=60):
+    """Seconds texelutil takes on a FEN it solves at once, i.e. (almost) only its startup; None if it doesn't answer."""
+    job = TexelJob("startup", TRIVIAL_FEN, timeout=timeout)
+    process = TexelProcess([job])
+    answered = job.done.wait(timeout)
+    process.stop()
+    return job.elapsed if answered and job.pgn is not None else None
+
+class ProofgameScheduler:
+    """
+    Keeps num_workers texelutil processes running at all times, each on a batch of up to fens_per_process FENs
+    (see TexelProcess): as soon as one exits, the next batch is started. Batches are kept smaller when there
+    are fewer FENs waiting than free workers could take. Each process runs in its own process group, so a
+    timeout kills exactly that process and nothing else.
+    If a store is given, every result is recorded in it as soon as its job finishes.
+
+    Several jobs may work on the same FEN (e.g. with different seeds); once one of them finds
+    a proof, the others are dropped and queued ones are skipped. No new jobs are started
+    once max_cpu_hours of texelutil time have been spent, and every job is stopped at the deadline.
+    If on_result is given, on_result(fen, pgn) is called as soon as each job has finished.
+    """
+
+    def __init__(self, num_workers=MAX_THREADS, timeout=TIMEOUT, store=None, max_cpu_hours=None, deadline=None, on_result=None,
+                 fens_per_process=FENS_PER_PROCESS):
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.store = store
+        self.max_cpu_hours = max_cpu_hours
+        self.deadline = deadline
+        self.on_result = on_result
+        self.fens_per_process = fens_per_process
+        self.counts = {"solved": 0, "failed": 0, "timeouts": 0}
+        self.results = {}
+        self.solved_fens = set()
+        self.cpu_seconds = 0.0
+        self.start_time = time.time()
+        self.starts = 0
+        self.startup_seconds = None  # measured on a trivial FEN by the first run()
+        # wall time and number of FENs of the texelutil processes that exited by themselves
+        self.batch_seconds = 0.0
+        self.batches = 0
+        self.batch_fens = 0
+
+    def out_of_budget(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            return True
+        return self.max_cpu_hours is not None and self.cpu_seconds > self.max_cpu_hours * 3600
+
+    def _batch(self, pending, free):
+        """Take the next batch off pending: jobs with the seed of the first one, one per position."""
+        size = min(self.fens_per_process, -(-len(pending) // free))
+        batch, keys, rest = [], set(), deque()
+        while pending:
+            job = pending.popleft()
+            if job.fen in self.solved_fens:
+                continue
+            if len(batch) < size and (not batch or job.seed == batch[0].seed) and position_key(job.fen) not in keys:
+                batch.append(job)
+                keys.add(position_key(job.fen))
+            else:
+                rest.append(job)
+        pending.extend(rest)
+        return batch
+
+    def _record(self, job):
+        job.recorded = True
+        if job.dropped:
+            return
+        thread_id, fen, pgn = job.thread_id, job.fen, job.pgn
+        self.results[thread_id] = pgn
+        if pgn:
+            status = "proof"
+            self.solved_fens.add(fen)
+            self.counts["solved"] += 1
+        elif job.timed_out:
+            status = "timeout"
+            self.counts["timeouts"] += 1
+        else:
+            status = "unknown"
+            self.counts["failed"] += 1
+        if self.store is not None:
+            self.store.put(fen, status, proof=pgn, seed=job.seed, budget=job.budget, elapsed=job.elapsed)
+        if self.on_result is not None:
+            self.on_result(fen, pgn)
+
+    def report(self, running):
+        minutes = (time.time() - self.start_time) / 60
+        rates = ", ".join(f"{k} {v} ({v / minutes:.1f}/min)" for k, v in self.counts.items())
+        print(f"[{minutes:.1f} min, {self.cpu_seconds / 3600:.2f} CPU-hours] running {running}, {rates}")
+        startup = self.startup_seconds or 0.0
+        solving = (self.batch_seconds - self.batches * startup) / max(self.batch_fens, 1)
+        print(f"    texelutil started {self.starts} times, startup {startup:.2f}s (timed on a trivial FEN); "
+              f"finished batches took {solving:.2f}s per FEN on top of their startup ({self.batch_fens} FENs)")
+
+    def run(self, jobs):
+        """
+        Run (thread_id, fen) or (thread_id, fen, seed, timeout) jobs.
+        jobs may also yield None when no job is available yet (e.g. while an earlier pipeline stage is
+        still producing FENs); the scheduler then asks again after its next poll.
+        Returns a dict thread_id -> validated proof game PGN (or None).
+        """
+        if self.startup_seconds is None:
+            self.startup_seconds = measure_startup()
+        jobs = iter(jobs)
+        pending = deque()
+        running = []
+        last_report = time.time()
+        exhausted = False
+
+        try:
+            while running or pending or not exhausted:
+                while not exhausted and len(pending) < (self.num_workers - len(running)) * self.fens_per_process:
+                    job = next(jobs, StopIteration)
+                    if job is StopIteration:
+                        exhausted = True
+                        break
+                    if job is None:
+                        break
+                    thread_id, fen, seed, timeout = (tuple(job) + (SEED, None))[:4]
+                    pending.append(TexelJob(thread_id, fen, seed, timeout or self.timeout))
+                if self.out_of_budget():
+                    exhausted = True
+                    pending.clear()
+                while pending and len(running) < self.num_workers:
+                    batch = self._batch(pending, self.num_workers - len(running))
+                    if batch:
+                        running.append(TexelProcess(batch, self.startup_seconds or 0.0))
+                        self.starts += 1
+
+                still_running = []
+                past_deadline = self.deadline is not None and time.time() > self.deadline
+                for process in running:
+                    for job in process.jobs:
+                        if job.fen in self.solved_fens and not job.done.is_set():
+                            # another seed already found a proof for this position
+                            process.drop(job)
+                    if not process.finished() and (time.time() - process.start > process.timeout or past_deadline):
+                        print(f"Batch of {len(process.jobs)} FENs: Timeout expired")
+                        # texelutil may have found proofs that it hadn't printed yet
+                        process.stop(salvage=True)
+                    for job in process.jobs:
+                        if job.done.is_set() and not job.recorded:
+                            self._record(job)
+                    if process.finished():
+                        elapsed = time.time() - process.start
+                        if not process.killed and not any(job.dropped for job in process.jobs):
+                            self.batch_seconds += elapsed
+                            self.batches += 1
+                            self.batch_fens += len(process.jobs)
+                        process.stop()
+                        self.cpu_seconds += elapsed
+                    else:
+                        still_running.append(process)
+                running = still_running
+
+                if time.time() - last_report > REPORT_INTERVAL:
+                    self.report(len(running))
+                    last_report = time.time()
+                time.sleep(POLL_INTERVAL)
+        finally:
+            for process in running:
+                process.stop()
+
+        self.report(0)
+        return self.results
+
+def parse_stages(spec : str):
+    """
+    Parse a portfolio spec like "10x1,60x2,180x4" into [(timeout, num_seeds), ...]:
+    every position first gets 10s with one seed, then unsolved ones get 60s with two seeds, and so on.
+    """
+    stages = []
+    for stage in spec.split(","):
+        timeout, _, num_seeds = stage.partition("x")
+        stages.append((float(timeout), int(num_seeds or 1)))
+    return stages
+
+def run_portfolio(fens, store, stages, num_workers=MAX_THREADS, max_cpu_hours=None, max_wall_hours=None):
+    """
+    Run every (canonical) FEN with a short budget first, then retry only the unsolved ones
+    with longer budgets and more seeds, which race each other in parallel.
+    Positions that were already tried with at least a stage's budget (in this or an earlier run) skip that stage.
+    Every FEN gets a texelutil process of its own, so that a stage's budget is exactly what each position had.
+    """
+    deadline = time.time() + max_wall_hours * 3600 if max_wall_hours is not None else None
+    scheduler = ProofgameScheduler(num_workers=num_workers, store=store, max_cpu_hours=max_cpu_hours, deadline=deadline,
+                                   fens_per_process=1)
+    thread_ids = itertools.count()
+
+    for timeout, num_seeds in stages:
+        if scheduler.out_of_budget():
+            print("Out of budget, stopping")
+            break
+        todo = []
+        for fen in fens:
+            row = store.get(fen)
+            if row is None or (row["status"] != "proof" and (row["budget"] or 0) < timeout):
+                todo.append(fen)
+        print(f"Stage {timeout:g}s x {num_seeds} seeds: {len(todo)} unsolved positions")
+        # seeds of the same position are adjacent, so they run at the same time
+        scheduler.run((next(thread_ids), fen, SEED + k, timeout) for fen in todo for k in range(num_seeds))
+    return scheduler
+
+def run_coordinator(fens, store, queue_path, timeout=TIMEOUT, serve=None):
+    """
+    Put the FENs on a shared LeaseQueue for workers on other machines (`proofgame.py --worker`),
+    optionally serving it over HTTP at serve="host:port", and merge their results into the store until all are done.
+    """
+    queue = LeaseQueue(queue_path, lease_seconds=max(DEFAULT_LEASE, 3 * timeout))
+    queue.add(fens, timeout)
+    server = None
+    if serve:
+        host, _, port = serve.rpartition(":")
+        server = serve_queue(queue, host or "0.0.0.0", int(port))
+    print(f"Queued {len(fens)} positions in {queue_path}; waiting for workers")
+
+    last_report = time.time()
+    while not queue.finished():
+        queue.merge_into(store)
+        if time.time() - last_report > REPORT_INTERVAL:
+            print("Queue:", queue.counts(), "Store:", store.counts())
+            last_report = time.time()
+        time.sleep(5)
+    queue.merge_into(store)
+    if server is not None:
+        server.shutdown()
+
+def run_worker(queue, num_workers=MAX_THREADS, worker_id=None, batch_size=None, idle_interval=5, fens_per_process=FENS_PER_PROCESS):
+    """
+    Claim batches of FENs from a shared queue (see proofgame_queue.py), solve them locally, and report
+    every result back, until the queue is empty. The leases of the FENs this worker holds are renewed
+    in the background, so they only expire if the worker dies.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    batch_size = batch_size or num_workers * fens_per_process
+    held = set()
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def on_result(fen, pgn):
+        with lock:
+            held.discard(fen)
+
+    def renew_leases():
+        interval = getattr(queue, "lease_seconds", DEFAULT_LEASE) / 3
+        while not stopped.wait(interval):
+            with lock:
+                fens = list(held)
+            if fens:
+                queue.renew(worker_id, fens)
+
+    def jobs():
+        thread_ids = itertools.count()
+        buffer = deque()
+        next_claim = 0
+        while True:
+            if not buffer and time.time() >= next_claim:
+                claimed = queue.claim(worker_id, batch_size)
+                with lock:
+                    held.update(fen for fen, _ in claimed)
+                buffer.extend(claimed)
+                if not claimed:
+                    with lock:
+                        idle = not held
+                    if idle and queue.finished():
+                        return
+                    # nothing to claim right now; expired leases may come back later
+                    next_claim = time.time() + idle_interval
+            if buffer:
+                fen, budget = buffer.popleft()
+                yield next(thread_ids), fen, SEED, budget
+            else:
+                yield None
+
+    threading.Thread(target=renew_leases, daemon=True).start()
+    scheduler = ProofgameScheduler(num_workers=num_workers, store=LeaseReporter(queue, worker_id), on_result=on_result,
+                                   fens_per_process=fens_per_process)
     try:
-        subprocess.run(command, shell=True, timeout=TIMEOUT)
-    except subprocess.TimeoutExpired:
-        print(f"Thread {thread_id}: Timeout expired")
+        scheduler.run(jobs())
+    finally:
+        stopped.set()
+    return scheduler
 
 def convert_to_pgn(moves):
     moves = moves.split()
@@ -104,18 +512,24 @@ def validate_pgn(pgn : str, fen : str, ignore_move_number=True):
     else:
         return board.fen() == fen
 
-def process_output(thread_id) -> str:
-    i = 0
-    while os.path.exists(f"{TEXELUTIL_RES_DIR}/result_t_{thread_id}_{i:02d}"):
-        i += 1
-    last_file = f"{TEXELUTIL_RES_DIR}/result_t_{thread_id}_{i - 1:02d}"
-    with open(last_file, "r") as f:
-        content = f.read()
-    match = re.search(r"legal: proof: (.*)", content)
+def last_output(workdir) -> str:
+    """The contents of the last intermediate result file texelutil wrote to workdir ("" if none)."""
+    files = sorted(name for name in os.listdir(workdir) if name.startswith("result_"))
+    if not files:
+        return ""
+    with open(os.path.join(workdir, files[-1]), "r") as f:
+        return f.read()
+
+def parse_result(content, fen, thread_id) -> str:
+    """The validated proof game PGN in texelutil's output, or None."""
+    if not content:
+        print(f"Thread {thread_id}: No output")
+        return None
+    match = PROOF_LINE.search(content)
     if match:
         moves = match.group(1)
         pgn = convert_to_pgn(moves)
-        if validate_pgn(pgn, fens[thread_id]):
+        if validate_pgn(pgn, fen):
             print(f"Thread {thread_id}: Proof game is valid")
             return pgn
         else:
@@ -126,43 +540,63 @@ def process_output(thread_id) -> str:
         return None
 
 def main(args):
-    global fens
+    if args.worker:
+        run_worker(open_queue(args.worker), num_workers=args.num_workers, fens_per_process=args.fens_per_process)
+        return
+
     if args.fens_file:
         df = pd.read_csv(args.fens_file)
         fens = df['FEN'].tolist()
     else:
         fens = fens_test
 
-    print(f"Computing {len(fens)} proof games")
-    for i in range(0, len(fens), MAX_THREADS):
-        print(f"Processing {i} to {i + MAX_THREADS}")
-        pool = multiprocessing.Pool(MAX_THREADS)
-        with pool:
-            pool.starmap(run_command, [(fen, i + thread_id) for thread_id, fen in enumerate(fens[i:i + MAX_THREADS])])
-        pool.close()
-        pool.join()
-        # kill texelutil bc it's not closing properly
-        subprocess.run("killall texelutil", shell=True)
-        time.sleep(5)
+    # Solve each distinct position once, and only if no earlier run has already done it
+    store = ProofgameStore(args.store)
+    if args.evaluate_prefilter:
+        evaluate_prefilter(store)
+        return
+    canonical = [move_01(fen) for fen in fens]
+    unique = list(dict.fromkeys(canonical))
+    if args.prefilter:
+        unique, rejected = prefilter(unique, threshold=args.prefilter_threshold)
+        print(f"Prefilter rejected {len(rejected)} positions:", dict(Counter(rejected.values())))
+    todo = [fen for fen in unique if not store.is_done(fen, retry_failed=args.retry_failed)]
+    print(f"{len(fens)} FENs, {len(unique)} distinct positions, computing {len(todo)} proof games")
+
+    if args.queue:
+        run_coordinator(todo, store, args.queue, timeout=args.timeout, serve=args.serve)
+    elif args.portfolio:
+        run_portfolio(unique, store, parse_stages(args.portfolio), num_workers=args.num_workers,
+                      max_cpu_hours=args.max_cpu_hours, max_wall_hours=args.max_wall_hours)
+    else:
+        scheduler = ProofgameScheduler(num_workers=args.num_workers, timeout=args.timeout, store=store,
+                                       max_cpu_hours=args.max_cpu_hours, fens_per_process=args.fens_per_process)
+        scheduler.run(enumerate(todo))
+    print("Store:", store.counts())
 
-    print("Processing output")
     if args.fens_file:
-        for thread_id in tqdm(range(len(fens))):
-            pgn = process_output(thread_id)
-            if pgn:
-                df.loc[thread_id, 'proofgame'] = pgn
-            else:
-                df.loc[thread_id, 'proofgame'] = None
+        df['proofgame'] = [store.proof(fen) for fen in canonical]
         df.to_csv(args.save_filename, index=False)
-    else:
-        for thread_id in tqdm(range(len(fens))):
-            process_output(thread_id)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--fens_file", help="CSV file with a 'FEN' column", default=None)
     parser.add_argument("--save_filename", help="File to save the results", default="/data/chess-data/lichess_puzzles/proofgame_pgns.csv")
+    parser.add_argument("--num_workers", "-j", type=int, default=MAX_THREADS, help="Number of texelutil processes to keep running")
+    parser.add_argument("--timeout", type=int, default=TIMEOUT, help="Timeout per FEN in seconds")
+    parser.add_argument("--store", default=f"{DATA_DIR}/proofgames.sqlite", help="Result store shared by all runs, keyed by position")
+    parser.add_argument("--retry_failed", action="store_true", help="Also retry positions that previously timed out or were not solved")
+    parser.add_argument("--portfolio", default=None, help='Escalating budgets as "timeout x seeds" stages, e.g. "10x1,60x2,180x4"')
+    parser.add_argument("--max_cpu_hours", type=float, default=None, help="Stop starting new jobs after this many texelutil CPU-hours")
+    parser.add_argument("--max_wall_hours", type=float, default=None, help="Stop the portfolio run after this many hours")
+    parser.add_argument("--prefilter", action="store_true", help="Skip provably unreachable positions and run the rest easiest-first")
+    parser.add_argument("--prefilter_threshold", type=float, default=None, help="With --prefilter, also skip positions with a hardness score above this")
+    parser.add_argument("--evaluate_prefilter", action="store_true", help="Measure the prefilter's hardness score against the results in --store and exit")
+    parser.add_argument("--queue", default=None, help="Instead of solving locally, put the positions on this shared SQLite queue for workers and wait for their results")
+    parser.add_argument("--serve", default=None, help='With --queue, also serve the queue over HTTP at "host:port"')
+    parser.add_argument("--worker", default=None, help="Run as a worker for a coordinator's queue (a SQLite path on shared storage, or the http:// URL of --serve)")
+    parser.add_argument("--fens_per_process", type=int, default=FENS_PER_PROCESS, help="Most FENs given to one texelutil process, so that its startup is paid once for all of them (not with --portfolio)")
     args = parser.parse_args()
     main(args)
 
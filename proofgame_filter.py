@@ -0,0 +1,149 @@
+"""
+Cheap static analysis of a position before spending texelutil time on it.
+
+position_features computes simple features of how far a position is from the initial one:
+missing pieces, the pawn captures needed to explain the pawn files, the promotions needed to explain
+the piece counts, pawns that left their start squares, and pieces that left their home squares.
+Some combinations are provably unreachable (e.g. more pawn captures than missing enemy pieces,
+or castling rights without the king and rook at home); those positions never need to be run.
+The rest get a hardness score, which is used to order positions easiest-first and, optionally,
+to skip the hardest ones. evaluate_prefilter measures the score against results in a ProofgameStore.
+"""
+
+import chess
+import numpy as np
+
+INITIAL_BOARD = chess.Board()
+
+# Weights of the hardness score; tune them with evaluate_prefilter
+WEIGHTS = {
+    "promoted": 3.0,
+    "pawn_captures": 2.0,
+    "pawn_advance": 0.25,
+    "displaced": 0.5,
+}
+
+
+def min_pawn_captures(files):
+    """
+    Lower bound on the captures needed to bring pawns from distinct start files to the given files:
+    each capture moves a pawn by one file. On a line, the optimal matching keeps the order.
+    """
+    files = sorted(files)
+    k = len(files)
+    if k > 8:
+        return None
+    inf = float("inf")
+    # best[i][j]: cost of matching the first i pawns to start files among the first j files
+    best = [[0] * 9] + [[inf] * 9 for _ in range(k)]
+    for i in range(1, k + 1):
+        for j in range(1, 9):
+            best[i][j] = min(best[i][j - 1], best[i - 1][j - 1] + abs(files[i - 1] - (j - 1)))
+    return best[k][8]
+
+
+def min_promotions(board, color):
+    """Pieces beyond the initial counts must have been promoted."""
+    bishops = board.pieces(chess.BISHOP, color)
+    light = len(bishops & chess.SquareSet(chess.BB_LIGHT_SQUARES))
+    dark = len(bishops) - light
+    return (max(0, len(board.pieces(chess.QUEEN, color)) - 1)
+            + max(0, len(board.pieces(chess.ROOK, color)) - 2)
+            + max(0, len(board.pieces(chess.KNIGHT, color)) - 2)
+            + max(0, light - 1) + max(0, dark - 1))
+
+
+def position_features(fen : str) -> dict:
+    board = chess.Board(fen)
+    features = {"valid": board.status() == chess.STATUS_VALID,
+                "castling_consistent": board.clean_castling_rights() == board.castling_rights}
+
+    for color, name in ((chess.WHITE, "white"), (chess.BLACK, "black")):
+        pawns = board.pieces(chess.PAWN, color)
+        start_rank = 1 if color == chess.WHITE else 6
+        features[f"{name}_missing"] = 16 - chess.popcount(board.occupied_co[color])
+        features[f"{name}_pawns"] = len(pawns)
+        features[f"{name}_pawn_captures"] = min_pawn_captures([chess.square_file(sq) for sq in pawns])
+        features[f"{name}_promoted"] = min_promotions(board, color)
+        features[f"{name}_pawn_advance"] = sum(abs(chess.square_rank(sq) - start_rank) for sq in pawns)
+        features[f"{name}_displaced"] = sum(
+            1 for sq in chess.SquareSet(INITIAL_BOARD.occupied_co[color] & ~INITIAL_BOARD.pawns)
+            if board.piece_at(sq) != INITIAL_BOARD.piece_at(sq))
+    return features
+
+
+def unreachable_reason(features):
+    """Returns why a position can provably not be reached from the initial position, or None."""
+    if not features["valid"]:
+        return "invalid"
+    if not features["castling_consistent"]:
+        return "castling"
+    for name, other in (("white", "black"), ("black", "white")):
+        if features[f"{name}_pawn_captures"] is None:
+            return "too many pawns"
+        if features[f"{name}_pawn_captures"] > features[f"{other}_missing"]:
+            return "pawn captures"
+        if features[f"{name}_pawns"] + features[f"{name}_promoted"] > 8:
+            return "promotions"
+    return None
+
+
+def hardness(features, weights=WEIGHTS):
+    return sum(weight * (features[f"white_{name}"] + features[f"black_{name}"]) for name, weight in weights.items())
+
+
+def prefilter(fens, threshold=None):
+    """
+    Drop provably unreachable positions (and, if threshold is given, positions with a hardness
+    above it), and order the rest easiest-first. Returns (kept_fens, rejected) where rejected maps fen -> reason.
+    """
+    scored = []
+    rejected = {}
+    for fen in fens:
+        features = position_features(fen)
+        reason = unreachable_reason(features)
+        score = hardness(features)
+        if reason is None and threshold is not None and score > threshold:
+            reason = "hard"
+        if reason is not None:
+            rejected[fen] = reason
+        else:
+            scored.append((score, fen))
+    scored.sort(key=lambda x: x[0])
+    return [fen for _, fen in scored], rejected
+
+
+def evaluate_prefilter(store, quantiles=(0.5, 0.75, 0.9, 0.95, 0.99)):
+    """
+    Compare the hardness score with the stored results: how well it ranks proofs before failures,
+    and what each threshold would have cost in lost proofs and saved texelutil time.
+    """
+    rows = [row for row in store.rows() if row["status"] is not None]
+    if not rows:
+        print("No stored results to evaluate against")
+        return
+
+    scores, solved, elapsed, unreachable = [], [], [], []
+    for row in rows:
+        features = position_features(row["fen"])
+        scores.append(hardness(features))
+        solved.append(row["status"] == "proof")
+        elapsed.append(row["elapsed"] or 0.0)
+        unreachable.append(unreachable_reason(features) is not None)
+    scores, solved, elapsed, unreachable = map(np.array, (scores, solved, elapsed, unreachable))
+
+    print(f"{len(rows)} positions, {solved.sum()} with a proof")
+    print(f"Flagged unreachable: {unreachable.sum()} ({(unreachable & solved).sum()} of them have a proof, should be 0)")
+
+    # Probability that a random proof scores lower (easier) than a random failure
+    if solved.any() and (~solved).any():
+        ranks = scores.argsort().argsort() + 1
+        auc = 1 - (ranks[solved].sum() - solved.sum() * (solved.sum() + 1) / 2) / (solved.sum() * (~solved).sum())
+        print(f"Ranking AUC (proofs easier than failures): {auc:.3f}")
+
+    print("threshold  rejected  proofs_lost  failures_avoided  cpu_saved")
+    for q in quantiles:
+        threshold = np.quantile(scores, q)
+        rejected = scores > threshold
+        print(f"{threshold:9.2f}  {rejected.mean():8.1%}  {(rejected & solved).sum() / max(solved.sum(), 1):11.1%}"
+              f"  {(rejected & ~solved).sum() / max((~solved).sum(), 1):16.1%}  {elapsed[rejected].sum() / max(elapsed.sum(), 1e-9):9.1%}")
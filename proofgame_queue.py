@@ -0,0 +1,198 @@
+"""
+Shared work queue for running proofgame.py on several machines.
+
+The coordinator puts the canonical FENs to solve into a LeaseQueue (a SQLite file, on shared storage
+or served over HTTP with serve_queue). Shared storage must have working POSIX locks, which many network
+filesystems don't (NFS often doesn't); if in doubt, serve the queue over HTTP. Workers claim batches of FENs under a time-limited lease, run
+texelutil locally, and report every result back; while they work, they renew the leases of the FENs
+they hold. If a worker dies, its leases expire and the FENs are handed out again, up to max_attempts
+times; after that they are marked "abandoned", which is not merged into the store, so that a later
+run tries them again. Results are merged into the coordinator's ProofgameStore as they come in.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from sqlite_connection import LocalConnection
+
+DEFAULT_LEASE = 600  # seconds
+MAX_ATTEMPTS = 3
+
+
+class LeaseQueue:
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE, max_attempts=MAX_ATTEMPTS):
+        self.path = str(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # not WAL: its shared-memory index only works for processes on one host, and the queue is shared between hosts
+        self._connection = LocalConnection(self.path, pragmas=("journal_mode=DELETE",), row_factory=sqlite3.Row,
+                                           isolation_level=None)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                fen TEXT PRIMARY KEY,
+                                budget REAL,
+                                state TEXT,
+                                owner TEXT,
+                                expires REAL,
+                                attempts INTEGER DEFAULT 0,
+                                status TEXT,
+                                proof TEXT,
+                                seed INTEGER,
+                                elapsed REAL,
+                                merged INTEGER DEFAULT 0)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, expires)")
+
+    def _transaction(self, fn):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def add(self, fens, budget):
+        """Queue FENs, in order. FENs that are already queued or leased are left alone; failed ones are queued again."""
+        self._transaction(lambda conn: conn.executemany(
+            """INSERT INTO jobs (fen, budget, state) VALUES (?, ?, 'queued')
+               ON CONFLICT(fen) DO UPDATE SET state='queued', budget=excluded.budget, owner=NULL, attempts=0, status=NULL, merged=0
+               WHERE jobs.state='done' AND jobs.merged=1 AND jobs.status != 'proof'""",
+            [(fen, budget) for fen in fens]))
+
+    def claim(self, worker, n):
+        """Lease up to n FENs to a worker: queued ones first, then ones whose lease has expired. Returns [(fen, budget)]."""
+        def claim(conn):
+            now = time.time()
+            # jobs that keep losing their workers are given up on, without a result
+            conn.execute("""UPDATE jobs SET state='done', status='abandoned', merged=0
+                            WHERE state='leased' AND expires < ? AND attempts >= ?""", (now, self.max_attempts))
+            rows = conn.execute("""SELECT fen, budget FROM jobs
+                                   WHERE state='queued' OR (state='leased' AND expires < ?)
+                                   ORDER BY state DESC, rowid LIMIT ?""", (now, n)).fetchall()
+            conn.executemany("UPDATE jobs SET state='leased', owner=?, expires=?, attempts=attempts+1 WHERE fen=?",
+                             [(worker, now + self.lease_seconds, row["fen"]) for row in rows])
+            return [(row["fen"], row["budget"]) for row in rows]
+        return self._transaction(claim)
+
+    def renew(self, worker, fens):
+        """Extend the leases a worker still holds."""
+        self._transaction(lambda conn: conn.executemany(
+            "UPDATE jobs SET expires=? WHERE fen=? AND owner=? AND state='leased'",
+            [(time.time() + self.lease_seconds, fen, worker) for fen in fens]))
+
+    def complete(self, worker, fen, status, proof=None, seed=None, budget=None, elapsed=None):
+        """Record a result. A late result from a worker whose lease expired is still accepted, but never replaces a proof."""
+        self._transaction(lambda conn: conn.execute(
+            """UPDATE jobs SET state='done', status=?, proof=?, seed=?, budget=?, elapsed=?, merged=0
+               WHERE fen=? AND (status IS NULL OR status != 'proof')""",
+            (status, proof, seed, budget, elapsed, fen)))
+
+    def merge_into(self, store):
+        """
+        Copy finished results that haven't been copied yet into a ProofgameStore. Returns how many.
+        Abandoned jobs were never finished by anyone, so they are left out of the store for later runs to retry.
+        The rows are read and marked in one transaction, so a result that comes in meanwhile isn't marked unseen.
+        """
+        def merge(conn):
+            rows = conn.execute("SELECT * FROM jobs WHERE state='done' AND merged=0").fetchall()
+            for row in rows:
+                if row["status"] == "abandoned":
+                    continue
+                store.put(row["fen"], row["status"], proof=row["proof"], seed=row["seed"], budget=row["budget"], elapsed=row["elapsed"])
+            conn.executemany("UPDATE jobs SET merged=1 WHERE fen=?", [(row["fen"],) for row in rows])
+            return sum(row["status"] != "abandoned" for row in rows)
+        return self._transaction(merge)
+
+    def counts(self):
+        rows = self._connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {state: n for state, n in rows}
+
+    def finished(self):
+        counts = self.counts()
+        return not counts.get("queued") and not counts.get("leased")
+
+
+class HttpLeaseQueue:
+    """Client side of serve_queue, with the same interface as LeaseQueue for workers."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def _post(self, path, **body):
+        response = self.session.post(f"{self.url}/{path}", json=body, timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def claim(self, worker, n):
+        return [tuple(job) for job in self._post("claim", worker=worker, n=n)]
+
+    def renew(self, worker, fens):
+        self._post("renew", worker=worker, fens=list(fens))
+
+    def complete(self, worker, fen, status, proof=None, seed=None, budget=None, elapsed=None):
+        self._post("complete", worker=worker, fen=fen, status=status, proof=proof, seed=seed, budget=budget, elapsed=elapsed)
+
+    def counts(self):
+        return self._post("counts")
+
+    def finished(self):
+        return self._post("finished")
+
+
+def open_queue(spec, **kwargs):
+    """A LeaseQueue for a SQLite path, or an HttpLeaseQueue for an http:// URL."""
+    spec = str(spec)
+    if spec.startswith("http://") or spec.startswith("https://"):
+        return HttpLeaseQueue(spec)
+    return LeaseQueue(spec, **kwargs)
+
+
+def serve_queue(queue, host="0.0.0.0", port=8765):
+    """Serve a LeaseQueue to workers over HTTP in a background thread. Returns the server."""
+    methods = {"claim": queue.claim, "renew": queue.renew, "complete": queue.complete,
+               "counts": queue.counts, "finished": queue.finished}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            method = methods.get(self.path.strip("/"))
+            if method is None:
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}")
+            response = json.dumps(method(**body)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving the proofgame queue on http://{host}:{port}")
+    return server
+
+
+class LeaseReporter:
+    """Store-like object for ProofgameScheduler that reports each result back to the queue."""
+
+    def __init__(self, queue, worker):
+        self.queue = queue
+        self.worker = worker
+
+    def put(self, fen, status, proof=None, seed=None, budget=None, elapsed=None):
+        self.queue.complete(self.worker, fen, status, proof=proof, seed=seed, budget=budget, elapsed=elapsed)
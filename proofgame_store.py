@@ -0,0 +1,69 @@
+"""
+Persistent store of proofgame results, keyed by canonical position (the FEN with the move counters
+set to "0 1", see proofgame.move_01), so that identical positions are only solved once across runs
+and datasets, independently of the row order of the input CSV.
+
+Each position records its status ("proof", "unknown" or "timeout"), the proof game PGN if one
+was found, the texelutil seed, the time budget, and the elapsed time.
+"""
+
+import os
+import sqlite3
+import time
+
+from sqlite_connection import LocalConnection
+
+STATUSES = ("proof", "unknown", "timeout")
+
+
+class ProofgameStore:
+    def __init__(self, path):
+        self.path = str(path)
+        self._connection = LocalConnection(self.path, row_factory=sqlite3.Row)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS proofgames (
+                                fen TEXT PRIMARY KEY,
+                                status TEXT,
+                                proof TEXT,
+                                seed INTEGER,
+                                budget REAL,
+                                elapsed REAL,
+                                updated REAL)""")
+
+    def get(self, fen):
+        """Returns the stored row for a canonical FEN as a dict, or None."""
+        row = self._connection().execute("SELECT * FROM proofgames WHERE fen = ?", (fen,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def put(self, fen, status, proof=None, seed=None, budget=None, elapsed=None):
+        """
+        Record a result. A stored proof is never overwritten by a later failure.
+        """
+        assert status in STATUSES, status
+        with self._connection() as conn:
+            conn.execute("""INSERT INTO proofgames VALUES (?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(fen) DO UPDATE SET
+                                status=excluded.status, proof=excluded.proof, seed=excluded.seed,
+                                budget=excluded.budget, elapsed=excluded.elapsed, updated=excluded.updated
+                            WHERE proofgames.status != 'proof' OR excluded.status = 'proof'""",
+                         (fen, status, proof, seed, budget, elapsed, time.time()))
+
+    def proof(self, fen):
+        row = self.get(fen)
+        return row["proof"] if row is not None else None
+
+    def is_done(self, fen, retry_failed=False):
+        """Whether a position needs no more work: solved, or (unless retry_failed) already attempted."""
+        row = self.get(fen)
+        if row is None:
+            return False
+        return row["status"] == "proof" or not retry_failed
+
+    def rows(self):
+        for row in self._connection().execute("SELECT * FROM proofgames"):
+            yield dict(row)
+
+    def counts(self):
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM proofgames GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
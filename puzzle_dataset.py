@@ -0,0 +1,194 @@
+"""
+Compact binary format for the puzzle datasets (pgn_puzzles.csv, pairs.csv, ...), so that consumers
+don't have to re-parse PGN and FEN text.
+
+A dataset is a directory of .npy files:
+    uids.npy                  fixed-width bytes
+    ratings.npy               int32
+    boards.npy                the puzzle position of each row, packed (PACKED_BOARD)
+    <game>.moves.npy          the moves of a game column (pgn, proofgame, solution), concatenated,
+    <game>.offsets.npy        and the start of each row's moves (CSR layout, len(dataset) + 1 entries)
+Moves are uint16 codes from_square | to_square << 6 | promotion << 12. The pgn and proofgame games start
+from the initial position, the solution from the puzzle position.
+
+PuzzleDataset memory-maps the arrays, so opening a dataset is instant and row accessors return views;
+chess.Board objects are only built (by pushing the decoded moves, without SAN parsing) when asked for.
+"""
+
+import os
+import csv
+import argparse
+from pathlib import Path
+
+import chess
+import numpy as np
+
+from pgn_to_fen import replay_movetext
+
+GAME_COLUMNS = ("pgn", "proofgame", "solution")
+
+PACKED_BOARD = np.dtype([
+    ("occupied", "<u8"),
+    ("pieces", "u1", 16),   # two 4-bit piece codes per byte, in square order of the occupied squares
+    ("flags", "u1"),        # bit 0: white to move, bits 1-4: castling rights KQkq
+    ("ep", "i1"),           # en passant square, -1 if none
+    ("halfmove", "<u2"),
+    ("fullmove", "<u2"),
+])
+CASTLING_SQUARES = (chess.BB_H1, chess.BB_A1, chess.BB_H8, chess.BB_A8)
+
+
+def encode_move(move):
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code):
+    code = int(code)
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+def pack_board(board):
+    packed = np.zeros((), dtype=PACKED_BOARD)
+    packed["occupied"] = board.occupied
+    nibbles = [piece.piece_type + (0 if piece.color == chess.WHITE else 6)
+               for piece in map(board.piece_at, chess.SquareSet(board.occupied))]
+    nibbles += [0] * (32 - len(nibbles))
+    packed["pieces"] = [low | high << 4 for low, high in zip(nibbles[::2], nibbles[1::2])]
+    packed["flags"] = (board.turn == chess.WHITE) | sum(
+        1 << (i + 1) for i, bb in enumerate(CASTLING_SQUARES) if board.castling_rights & bb)
+    packed["ep"] = board.ep_square if board.has_legal_en_passant() else -1
+    packed["halfmove"] = board.halfmove_clock
+    packed["fullmove"] = board.fullmove_number
+    return packed
+
+
+def unpack_board(packed):
+    board = chess.Board(None)
+    nibbles = [nibble for byte in packed["pieces"].tolist() for nibble in (byte & 15, byte >> 4)]
+    for square, code in zip(chess.SquareSet(int(packed["occupied"])), nibbles):
+        board.set_piece_at(square, chess.Piece((code - 1) % 6 + 1, chess.WHITE if code <= 6 else chess.BLACK))
+    flags = int(packed["flags"])
+    board.turn = bool(flags & 1)
+    board.castling_rights = sum(bb for i, bb in enumerate(CASTLING_SQUARES) if flags & (1 << (i + 1)))
+    board.ep_square = int(packed["ep"]) if packed["ep"] >= 0 else None
+    board.halfmove_clock = int(packed["halfmove"])
+    board.fullmove_number = int(packed["fullmove"])
+    return board
+
+
+def san_to_moves(board, sans):
+    """Convert SAN moves played from board to chess.Moves (stops at the first illegal one); board is not modified."""
+    board = board.copy(stack=False)
+    moves = []
+    for san in sans:
+        try:
+            move = board.push_san(san)
+        except ValueError:
+            break
+        moves.append(move)
+    return moves
+
+
+def write_dataset(path, uids, ratings, boards, games):
+    """
+    Write a dataset: boards are the puzzle positions, games maps a game column name to one list of
+    chess.Moves per row.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    columns = {"uids": np.array(uids, dtype="S"), "ratings": np.array(ratings, dtype=np.int32),
+               "boards": np.array([pack_board(board) for board in boards], dtype=PACKED_BOARD)}
+    for name, rows in games.items():
+        columns[f"{name}.moves"] = np.fromiter((encode_move(move) for moves in rows for move in moves), dtype=np.uint16)
+        columns[f"{name}.offsets"] = np.concatenate([[0], np.cumsum([len(moves) for moves in rows])]).astype(np.int64)
+    for name, data in columns.items():
+        tmp = path / f"{name}.npy.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp, path / f"{name}.npy")
+
+
+def convert_rows(rows, path):
+    """
+    Write a dataset from dicts with uid, rating, pgn, solution and optionally proofgame (the columns of
+    pgn_puzzles.csv and pairs.csv); the puzzle position is the end of the pgn game.
+    """
+    uids, ratings, boards = [], [], []
+    games = {name: [] for name in GAME_COLUMNS}
+    for row in rows:
+        board = replay_movetext(row["pgn"])
+        uids.append(row["uid"])
+        ratings.append(int(row["rating"]))
+        boards.append(board)
+        games["pgn"].append(board.move_stack)
+        games["solution"].append(san_to_moves(board, row["solution"].split()))
+        if row.get("proofgame") is not None:
+            games["proofgame"].append(replay_movetext(row["proofgame"]).move_stack)
+    if len(games["proofgame"]) != len(uids):
+        del games["proofgame"]
+    write_dataset(path, uids, ratings, boards, games)
+    return len(uids)
+
+
+def convert_csv(input_file, path):
+    """Convert pgn_puzzles.csv (no header) or pairs.csv (with a header) to a dataset."""
+    with open(input_file) as f:
+        first = next(csv.reader(f))
+        f.seek(0)
+        fieldnames = None if first[0] == "uid" else ["uid", "rating", "pgn", "solution"]
+        return convert_rows(csv.DictReader(f, fieldnames=fieldnames), path)
+
+
+class PuzzleDataset:
+    def __init__(self, path):
+        self.path = Path(path)
+        load = lambda name: np.load(self.path / f"{name}.npy", mmap_mode="r")
+        self.uids = load("uids")
+        self.ratings = load("ratings")
+        self.boards = load("boards")
+        self.games = {name: (load(f"{name}.moves"), load(f"{name}.offsets"))
+                      for name in GAME_COLUMNS if (self.path / f"{name}.moves.npy").exists()}
+
+    def __len__(self):
+        return len(self.uids)
+
+    def uid(self, i):
+        return self.uids[i].decode()
+
+    def moves(self, name, i):
+        """The move codes of row i of a game column (a view)."""
+        moves, offsets = self.games[name]
+        return moves[offsets[i]:offsets[i + 1]]
+
+    def move_list(self, name, i):
+        return [decode_move(code) for code in self.moves(name, i)]
+
+    def board(self, i):
+        """The puzzle position of row i (without the moves that led to it)."""
+        return unpack_board(self.boards[i])
+
+    def game_board(self, name, i):
+        """The board at the end of a game column (pgn or proofgame) of row i, with its moves on the stack."""
+        board = chess.Board()
+        for move in self.move_list(name, i):
+            board.push(move)
+        return board
+
+    def solution(self, i):
+        """The solution of row i in SAN, as in the solution column of the CSV files."""
+        board = self.board(i)
+        sans = []
+        for move in self.move_list("solution", i):
+            sans.append(board.san(move))
+            board.push(move)
+        return " ".join(sans)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", help="pgn_puzzles.csv or pairs.csv")
+    parser.add_argument("output", help="Dataset directory to write")
+    args = parser.parse_args()
+
+    n = convert_csv(args.input_file, args.output)
+    print(f"Wrote {n} rows to {args.output}")
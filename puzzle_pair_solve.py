@@ -1,12 +1,11 @@
-import chess
+import argparse
 import numpy as np
-import io
-import json
 import csv
 from pathlib import Path
 from tqdm import tqdm
-from puzzle_solver import convert_pgn_to_game, solve_puzzle
+from puzzle_solver import board_from_pgn, solve_puzzles
 import chessllm
+from puzzle_dataset import PuzzleDataset
 from matplotlib import pyplot as plt
 
 DATA_DIR = Path("/data/chess-data/lichess_puzzles")  
@@ -25,45 +24,52 @@ convert_pgn_to_game(pgn_moves) -> game
 DATA_DIR = Path("/data/chess-data/lichess_puzzles")  
 FILE_NAME = DATA_DIR / "pairs.csv"
 
-def plot_acc_pairs(engine, bucket_size=200, enough_samples=10):
+def read_pairs(file_name):
+    """(rating, loader) for each pair; loader() returns (pgn board, proofgame board, solution)."""
+    if Path(file_name).is_dir():
+        # binary dataset (see puzzle_dataset.py): boards are only built for the sampled pairs
+        dataset = PuzzleDataset(file_name)
+        for i, rating in enumerate(dataset.ratings.tolist()):
+            yield rating, lambda i=i: (dataset.game_board("pgn", i), dataset.game_board("proofgame", i), dataset.solution(i))
+        return
+    with open(file_name) as f:
+        reader = csv.reader(f)
+        print(reader.__next__())
+        for uid, rating, pgn, proofgame, solution in tqdm(list(reader)):
+            yield rating, lambda pgn=pgn, proofgame=proofgame, solution=solution: (board_from_pgn(pgn), board_from_pgn(proofgame), solution)
+
+def plot_acc_pairs(engine, bucket_size=200, enough_samples=10, num_workers=1, speculative=False, file_name=FILE_NAME):
     # Create buckets
     buckets = {i*bucket_size: [] for i in range(30)}
 
     # Read the data and sort into buckets
-    with open(FILE_NAME) as f:
-        reader = csv.reader(f)
-        print(reader.__next__())
-        for uid, rating, pgn, proofgame, solution in tqdm(list(reader)):
-            rating_bucket = int(rating) // bucket_size * bucket_size
-            if len(buckets[rating_bucket]) < enough_samples:
-                buckets[rating_bucket].append((pgn, proofgame, solution))
+    for rating, loader in read_pairs(file_name):
+        rating_bucket = int(rating) // bucket_size * bucket_size
+        if len(buckets[rating_bucket]) < enough_samples:
+            buckets[rating_bucket].append(loader())
 
     # print how many elems in buckets
     for k, v in buckets.items():
         print(f'rating [{k}, {k + bucket_size})', 'n', len(v))
     nonempty_buckets = [k for k, v in buckets.items() if len(v) > 0]
 
-    # Test the puzzles
+    # Test the puzzles; both sides of each pair are scheduled as separate jobs
     ok_pgn = {i*bucket_size: [] for i in range(30)}
     ok_proofgame = {i*bucket_size: [] for i in range(30)}
-    for rating_bucket, puzzles in tqdm(buckets.items()):
-        for pgn, proofgame, solution in puzzles:
-            board_pgn = chess.Board()
-            board_proofgame = chess.Board()
-
-            print("pgn origi", pgn)
-            print("proofgame", proofgame)
-            # Iterate over the moves and apply them to the board
-            for move in convert_pgn_to_game(pgn).mainline_moves():
-                board_pgn.push(move)
-            for move in convert_pgn_to_game(proofgame).mainline_moves():
-                board_proofgame.push(move)
-
-            is_right_pgn = solve_puzzle(board_pgn, solution, engine)
-            is_right_proofgame = solve_puzzle(board_proofgame, solution, engine)
-
-            ok_pgn[rating_bucket].append(is_right_pgn)
-            ok_proofgame[rating_bucket].append(is_right_proofgame)
+    tasks = []
+    jobs = []
+    for rating_bucket, puzzles in buckets.items():
+        for pgn_board, proofgame_board, solution in puzzles:
+            print("pgn origi", chessllm.PgnPrompt.of(pgn_board).movetext())
+            print("proofgame", chessllm.PgnPrompt.of(proofgame_board).movetext())
+            tasks.append(rating_bucket)
+            jobs.append((pgn_board, solution))
+            jobs.append((proofgame_board, solution))
+
+    results = solve_puzzles(engine, jobs, num_workers, speculative)
+    for i, rating_bucket in enumerate(tasks):
+        ok_pgn[rating_bucket].append(results[2*i])
+        ok_proofgame[rating_bucket].append(results[2*i + 1])
 
     # Compare the results
     for bucket_start in nonempty_buckets:
@@ -92,8 +98,15 @@ def plot_acc_pairs(engine, bucket_size=200, enough_samples=10):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_workers", "-j", type=int, default=8, help="Number of puzzles to solve concurrently")
+    parser.add_argument("--speculative", action="store_true", help="Play the moves of the model's continuation that match the solution without new requests")
+    parser.add_argument("--early_stop", action="store_true", help="Stop generating as soon as one move has been received (ignored with --speculative, which needs the lookahead)")
+    parser.add_argument("--file_name", "-f", default=FILE_NAME, help="Pairs file (a CSV, or a dataset directory written by puzzle_dataset.py)")
+    args = parser.parse_args()
+
     api_key = open("OPENAI_API_KEY").read().strip()
-    config = { "temperature": 0, "num_lookahead_tokens": 30}
+    config = { "temperature": 0, "num_lookahead_tokens": 30, "early_stop": args.early_stop}
     engine = chessllm.ChessLLM(api_key, config, model="gpt-3.5-turbo-instruct")
-    plot_acc_pairs(engine)
+    plot_acc_pairs(engine, num_workers=args.num_workers, speculative=args.speculative, file_name=args.file_name)
 
@@ -19,10 +19,12 @@ import argparse
 import chess
 import numpy as np
 import io
-import csv
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import chessllm
+from puzzle_dataset import PuzzleDataset
 import matplotlib.pyplot as plt
 
 def convert_pgn_to_game(pgn_moves):
@@ -32,51 +34,122 @@ def convert_pgn_to_game(pgn_moves):
         return None
     return game
 
-def solve_puzzle(board, solution, engine):
+# Outcome of each of the model's plies in a puzzle trace
+PLY_NOT_REACHED = -1
+PLY_WRONG = 0
+PLY_CORRECT = 1
+PLY_MATE = 2  # not the solution move, but it mates
+PLY_ILLEGAL = 3  # no legal move in the reply
+
+def solve_puzzle(board, solution, engine, speculative=False, stats=None, header=None, trace=None):
+    """
+    Whether the engine plays every move of the solution (or mates instead).
+    With speculative=True, the rest of the model's continuation is checked against the solution,
+    including the opponent's replies, and the moves it got right are played without a new request;
+    a new request is only made at the first divergence. Otherwise, one request is made per move.
+    If stats (a Counter) is given, it counts "requests" made and requests "saved" by speculation.
+    header overrides the engine's PGN header. If trace (a list) is given, the outcome of each
+    of the model's plies (PLY_CORRECT, PLY_WRONG, ...) is appended to it.
+    """
+    if stats is None:
+        stats = Counter()
     solution = solution.split()
+    speculated = []
     while True:
-        guess_next_move = engine.get_best_move(board)
         real_next_move, *solution = solution
+        if speculated and speculated[0] == real_next_move:
+            guess_next_move, *speculated = speculated
+            stats["saved"] += 1
+        else:
+            stats["requests"] += 1
+            if speculative:
+                guess_next_move, *speculated = engine.get_continuation(board, header=header) or [None]
+            else:
+                guess_next_move = engine.get_best_move(board, header=header)
         if guess_next_move != real_next_move:
+            outcome = PLY_WRONG
             try:
                 board.push_san(guess_next_move)
                 if board.is_checkmate():
-                    return True
+                    outcome = PLY_MATE
             except:
-                pass
-            return False
+                outcome = PLY_ILLEGAL
+            if trace is not None:
+                trace.append(outcome)
+            return outcome == PLY_MATE
+        if trace is not None:
+            trace.append(PLY_CORRECT)
         board.push_san(guess_next_move)
         if len(solution) > 0:
             opponent_move, *solution = solution
             board.push_san(opponent_move)
+            # the model's continuation only stays usable if it predicted the opponent's reply
+            speculated = speculated[1:] if speculated and speculated[0] == opponent_move else []
         else:
             break
     return True
 
-def plot_acc(engine, file_name, bucket_size, enough_samples):
+def board_from_pgn(pgn):
+    board = chess.Board()
+    for move in convert_pgn_to_game(pgn).mainline_moves():
+        board.push(move)
+    return board
+
+def solve_puzzles(engine, puzzles, num_workers=1, speculative=False, traces=None):
+    """
+    Solve a list of (board, solution) or (board, solution, header) puzzles, running up to num_workers of them at once.
+    The plies of each puzzle are still played in order by a single worker;
+    the results are returned in the same order as the input, so bucketing stays deterministic.
+    If traces is given (one list per puzzle), the ply outcomes of each puzzle are appended to it.
+    """
+    stats = [Counter() for _ in puzzles]
+    jobs = [(board, solution, engine, speculative, stats[i], header[0] if header else None, traces[i] if traces is not None else None)
+            for i, (board, solution, *header) in enumerate(puzzles)]
+    if num_workers <= 1:
+        results = [solve_puzzle(*job) for job in tqdm(jobs)]
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(solve_puzzle, *job) for job in jobs]
+            results = [future.result() for future in tqdm(futures)]
+
+    total = sum(stats, Counter())
+    print(f"Requests: {total['requests']}, saved by speculation: {total['saved']}")
+    if hasattr(engine, "stats"):
+        print("Engine:", engine.stats())
+    return results
+
+def plot_acc(engine, file_name, bucket_size, enough_samples, num_workers=1, speculative=False):
     buckets = {i*bucket_size: [] for i in range(15)}
 
-    import pandas as pd
-    with open(file_name) as f:
-        df = pd.read_csv(f)
+    if Path(file_name).is_dir():
+        # binary dataset (see puzzle_dataset.py): boards are only built for the sampled rows
+        dataset = PuzzleDataset(file_name)
+        rows = enumerate(dataset.ratings.tolist())
+        load = lambda i: (dataset.game_board("pgn", i), dataset.solution(i))
+    else:
+        import pandas as pd
+        with open(file_name) as f:
+            df = pd.read_csv(f)
         # add column names
         df.columns = ['uid', 'rating', 'pgn', 'solution']
-        for i, row in tqdm(df.iterrows()):
-            rating_bucket = int(row['rating']) // bucket_size * bucket_size
-            if len(buckets[rating_bucket]) < enough_samples:
-                buckets[rating_bucket].append((row['pgn'], row['solution']))
+        rows = ((row, row['rating']) for _, row in df.iterrows())
+        load = lambda row: (board_from_pgn(row['pgn']), row['solution'])
+
+    for row, rating in tqdm(rows):
+        rating_bucket = int(rating) // bucket_size * bucket_size
+        if len(buckets[rating_bucket]) < enough_samples:
+            buckets[rating_bucket].append(row)
 
     for k, v in buckets.items():
         print(f'rating [{k}, {k + bucket_size})', 'n', len(v))
 
     ok = [[] for _ in range(15)]
-    for rating_bucket, puzzles in buckets.items():
-        for pgn, solution in puzzles:
-            board = chess.Board()
-            for move in convert_pgn_to_game(pgn).mainline_moves():
-                board.push(move)
-            is_right = solve_puzzle(board, solution, engine)
-            ok[rating_bucket//bucket_size].append(is_right)
+    tasks = [(rating_bucket, *load(row))
+             for rating_bucket, puzzles in buckets.items()
+             for row in puzzles]
+    results = solve_puzzles(engine, [(board, solution) for _, board, solution in tasks], num_workers, speculative)
+    for (rating_bucket, _, _), is_right in zip(tasks, results):
+        ok[rating_bucket//bucket_size].append(is_right)
 
     ratings = []
     for i, x in enumerate(ok):
@@ -101,16 +174,19 @@ def plot_acc(engine, file_name, bucket_size, enough_samples):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", "-d", default="/data/chess-data/lichess_puzzles", help="Path to the data directory")
-    parser.add_argument("--file_name", "-f", default="pgn_puzzles.csv", help="Name of the input file")
+    parser.add_argument("--file_name", "-f", default="pgn_puzzles.csv", help="Name of the input file (a CSV, or a dataset directory written by puzzle_dataset.py)")
     parser.add_argument("--no_cache", dest="use_cache", action="store_false", help="Don't use cache for ChessLLM")
     parser.add_argument("--bucket_size", "-b", type=int, default=200, help="Size of the rating bucket")
     parser.add_argument("--enough_samples", "-e", type=int, default=10, help="Minimum number of samples required in a bucket")
     parser.add_argument("--model", default="gpt-3.5-turbo-instruct", help="Model name")
+    parser.add_argument("--num_workers", "-j", type=int, default=8, help="Number of puzzles to solve concurrently")
+    parser.add_argument("--speculative", action="store_true", help="Play the moves of the model's continuation that match the solution without new requests")
+    parser.add_argument("--early_stop", action="store_true", help="Stop generating as soon as one move has been received (ignored with --speculative, which needs the lookahead)")
     args = parser.parse_args()
 
     api_key = open("OPENAI_API_KEY").read().strip()
-    engine = chessllm.ChessLLM(api_key, config={"temperature": 0, "num_lookahead_tokens": 30}, 
+    engine = chessllm.ChessLLM(api_key, config={"temperature": 0, "num_lookahead_tokens": 30, "early_stop": args.early_stop}, 
                                model=args.model,
                                use_cache=args.use_cache)
     file_name = Path(args.data_dir) / args.file_name
-    plot_acc(engine, file_name, args.bucket_size, args.enough_samples)
+    plot_acc(engine, file_name, args.bucket_size, args.enough_samples, args.num_workers, args.speculative)
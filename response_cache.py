@@ -0,0 +1,106 @@
+"""
+On-disk cache for model responses, shared between threads and worker processes.
+
+Responses are keyed on (model, normalized prompt, max_tokens, temperature) and stored in a
+SQLite database in WAL mode, so many readers and one writer at a time can use it concurrently.
+The key is a hash, so every lookup is a single primary key probe regardless of the cache size.
+Entries older than max_age are dropped, and when the cache grows over max_entries the oldest
+entries are evicted.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+
+from sqlite_connection import LocalConnection
+
+DEFAULT_CACHE_PATH = os.environ.get("CHESSLLM_CACHE", "/data/chess/cache/responses.sqlite")
+DEFAULT_MAX_AGE = datetime.timedelta(days=30)
+DEFAULT_MAX_ENTRIES = 2_000_000
+EVICT_EVERY = 1000  # run eviction once every this many inserts
+
+
+def normalize_prompt(prompt : str) -> str:
+    """
+    Normalize line endings and unicode representation.
+    Trailing whitespace is kept: a completion model continues differently after "1." and "1. ".
+    """
+    return unicodedata.normalize("NFC", prompt.replace("\r\n", "\n"))
+
+
+def cache_key(model, prompt, max_tokens, temperature, **options) -> str:
+    """
+    options (e.g. stop sequences) are part of the key only when set, so plain requests keep their keys.
+    """
+    key = [model, normalize_prompt(prompt), int(max_tokens), float(temperature)]
+    options = {k: v for k, v in options.items() if v is not None}
+    if options:
+        key.append(sorted(options.items()))
+    payload = json.dumps(key)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_age=DEFAULT_MAX_AGE, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = str(path)
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._connection = LocalConnection(self.path, pragmas=("journal_mode=WAL", "synchronous=NORMAL"))
+        self._lock = threading.Lock()
+        self._inserts = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                model TEXT,
+                                response TEXT,
+                                created REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+        self.evict()
+
+    def get(self, model, prompt, max_tokens, temperature, **options):
+        row = self._connection().execute(
+            "SELECT response, created FROM responses WHERE key = ?",
+            (cache_key(model, prompt, max_tokens, temperature, **options),)).fetchone()
+        with self._lock:
+            if row is None or time.time() - row[1] > self.max_age.total_seconds():
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, model, prompt, max_tokens, temperature, response, **options):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                         (cache_key(model, prompt, max_tokens, temperature, **options), model, response, time.time()))
+        with self._lock:
+            self._inserts += 1
+            evict = self._inserts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop entries older than max_age, then the oldest entries beyond max_entries."""
+        with self._connection() as conn:
+            conn.execute("DELETE FROM responses WHERE created < ?",
+                         (time.time() - self.max_age.total_seconds(),))
+            (n,) = conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if n > self.max_entries:
+                conn.execute("""DELETE FROM responses WHERE key IN
+                                (SELECT key FROM responses ORDER BY created LIMIT ?)""",
+                             (n - self.max_entries,))
+
+    def __len__(self):
+        (n,) = self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()
+        return n
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
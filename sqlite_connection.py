@@ -0,0 +1,34 @@
+"""
+Per-thread SQLite connections for the SQLite-backed stores (response_cache.py, proofgame_store.py, proofgame_queue.py).
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class LocalConnection:
+    """
+    Calling it returns the calling thread's connection to a SQLite database, opened on first use with the
+    given PRAGMAs. sqlite connections must not be shared across threads or forked processes, so every
+    thread gets its own, and a forked child opens new ones instead of using its parent's.
+    """
+
+    def __init__(self, path, pragmas=("journal_mode=WAL",), row_factory=None, **connect_kwargs):
+        self.path = str(path)
+        self.pragmas = pragmas
+        self.row_factory = row_factory
+        self.connect_kwargs = connect_kwargs
+        self._local = threading.local()
+
+    def __call__(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, **self.connect_kwargs)
+            for pragma in self.pragmas:
+                conn.execute(f"PRAGMA {pragma}")
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn